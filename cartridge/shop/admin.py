@@ -402,6 +402,8 @@ class SaleAdmin(admin.ModelAdmin):
         "discount_exact",
         "valid_from",
         "valid_to",
+        "update_status",
+        "update_progress",
     )
     list_editable = (
         "active",
@@ -425,7 +427,9 @@ class SaleAdmin(admin.ModelAdmin):
             {"fields": (("discount_deduct", "discount_percent", "discount_exact"),)},
         ),
         (_("Sale period"), {"fields": (("valid_from", "valid_to"),)}),
+        (_("Update"), {"fields": (("update_status", "update_progress"),)}),
     )
+    readonly_fields = ("update_status", "update_progress")
 
 
 class DiscountCodeAdmin(admin.ModelAdmin):
@@ -1,16 +1,39 @@
 """
 Checkout process utilities.
 """
+import asyncio
 import decimal
 import locale
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+from hashlib import md5
+from threading import Lock
 
+from asgiref.sync import async_to_sync, sync_to_async
+from django.db import close_old_connections, connection, transaction
+from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 from mezzanine.accounts import ProfileNotConfigured, get_profile_for_user
 from mezzanine.conf import settings
 from mezzanine.utils.email import send_mail_template
 
-from cartridge.shop.models import Order
-from cartridge.shop.utils import set_shipping, set_tax, sign
+from cartridge.shop.models import Order, OrderEmail
+from cartridge.shop.utils import clear_session, set_shipping, set_tax, sign
+
+logger = logging.getLogger(__name__)
+
+# Order form field prefixes, and session variables, that the
+# billing/shipping and tax handlers are assumed to depend on along
+# with the cart's contents.
+HANDLER_ORDER_PREFIXES = ("billing_detail_", "shipping_detail_", "same_billing")
+HANDLER_SESSION_VARS = ("discount_code", "discount_total", "free_shipping")
+
+# Session variables stored with the memoised handler results even if
+# the handlers didn't change them.
+HANDLER_RESULT_VARS = ("shipping_type", "shipping_total", "tax_type", "tax_total")
+
+_handler_executor = None
+_handler_executor_lock = Lock()
 
 
 class CheckoutError(Exception):
@@ -88,6 +111,231 @@ def default_order_handler(request, order_form, order):
     pass
 
 
+def call_handler(handler, *args):
+    """
+    Call a checkout handler, which may be either a function or a
+    coroutine function. Coroutine functions are run to completion via
+    ``async_to_sync``, which under ASGI awaits them on the server's
+    event loop rather than blocking it.
+    """
+    if asyncio.iscoroutinefunction(handler):
+        return async_to_sync(handler)(*args)
+    return handler(*args)
+
+
+def billship_and_tax(request, order_form, billship_handler, tax_handler):
+    """
+    Call the billing/shipping handler followed by the tax handler. If
+    both are coroutine functions they're awaited concurrently, and if
+    ``SHOP_CHECKOUT_HANDLER_THREADS`` is set, sync handlers are called
+    concurrently in a thread pool, so that lookups with external
+    shipping and tax services don't wait on each other. In these cases
+    the tax handler can't rely on the shipping set by the
+    billing/shipping handler.
+
+    If ``SHOP_CHECKOUT_HANDLER_MEMO`` is True, the handlers aren't
+    called again while their inputs are unchanged, as given by
+    ``handler_memo_key``, and the session variables they set are
+    restored instead.
+    """
+    handlers = (billship_handler, tax_handler)
+    key = handler_memo_key(request, handlers)
+    if restore_handler_memo(request, key):
+        return
+    before = dict(request.session.items())
+    if all(asyncio.iscoroutinefunction(handler) for handler in handlers):
+        async_to_sync(gather_handlers)(handlers, request, order_form)
+    elif settings.SHOP_CHECKOUT_HANDLER_THREADS:
+        call_handlers_in_threads(handlers, request, order_form)
+    else:
+        for handler in handlers:
+            call_handler(handler, request, order_form)
+    store_handler_memo(request, key, before)
+
+
+async def abillship_and_tax(request, order_form, billship_handler, tax_handler):
+    """
+    Async version of ``billship_and_tax``, which awaits coroutine
+    function handlers and runs other handlers in a thread.
+    """
+    handlers = (billship_handler, tax_handler)
+    key = await sync_to_async(handler_memo_key)(request, handlers)
+    if restore_handler_memo(request, key):
+        return
+    before = dict(request.session.items())
+    if all(asyncio.iscoroutinefunction(handler) for handler in handlers):
+        await gather_handlers(handlers, request, order_form)
+    elif settings.SHOP_CHECKOUT_HANDLER_THREADS:
+        call = sync_to_async(call_handlers_in_threads)
+        await call(handlers, request, order_form)
+    else:
+        for handler in handlers:
+            if not asyncio.iscoroutinefunction(handler):
+                handler = sync_to_async(handler)
+            await handler(request, order_form)
+    store_handler_memo(request, key, before)
+
+
+def handler_memo_key(request, handlers):
+    """
+    Returns a hash of the inputs to the given handlers - the handlers
+    themselves, the cart's contents, the address fields of the order
+    form stored in the session, and the discount applied. Returns
+    None if ``SHOP_CHECKOUT_HANDLER_MEMO`` is False.
+    """
+    if not settings.SHOP_CHECKOUT_HANDLER_MEMO:
+        return None
+    order = request.session.get("order") or {}
+    inputs = [
+        [getattr(h, "__module__", ""), getattr(h, "__qualname__", "")] for h in handlers
+    ]
+    inputs.append(request.cart.fingerprint())
+    inputs.append(
+        sorted(
+            (name, str(value))
+            for name, value in order.items()
+            if name.startswith(HANDLER_ORDER_PREFIXES)
+        )
+    )
+    inputs.append([str(request.session.get(name)) for name in HANDLER_SESSION_VARS])
+    return md5(repr(inputs).encode("utf-8")).hexdigest()
+
+
+def restore_handler_memo(request, key):
+    """
+    If the handler results stored in the session are for the given
+    memo key, set the session variables from them and return True.
+    """
+    memo = request.session.get("checkout_handlers")
+    if key is None or not memo or memo["key"] != key:
+        return False
+    request.session.update(memo["set"])
+    clear_session(request, *memo["removed"])
+    return True
+
+
+def store_handler_memo(request, key, before):
+    """
+    Store the session variables set or removed by the handlers since
+    the session contained ``before``, against the given memo key.
+    """
+    if key is None:
+        return
+    session = request.session
+    changed = [name for name, value in session.items() if before.get(name) != value]
+    names = set(changed).union(HANDLER_RESULT_VARS) - {"order", "checkout_handlers"}
+    session["checkout_handlers"] = {
+        "key": key,
+        "set": {name: session[name] for name in names if name in session},
+        "removed": [name for name in before if name not in session],
+    }
+
+
+def call_handlers_in_threads(handlers, *args):
+    """
+    Call the given handlers concurrently using the thread pool sized
+    by ``SHOP_CHECKOUT_HANDLER_THREADS``. If any of them raise an
+    exception, the first in the order given is raised again once all
+    of them have completed. Each thread uses its own database
+    connection, which can't see changes that haven't been committed,
+    so if a transaction is open, such as with ``ATOMIC_REQUESTS``, the
+    handlers are called one after the other instead.
+    """
+    if connection.in_atomic_block:
+        return [call_handler(handler, *args) for handler in handlers]
+    global _handler_executor
+    with _handler_executor_lock:
+        if _handler_executor is None:
+            _handler_executor = ThreadPoolExecutor(
+                max_workers=settings.SHOP_CHECKOUT_HANDLER_THREADS,
+                thread_name_prefix="cartridge-checkout",
+            )
+
+    def call(handler):
+        try:
+            return call_handler(handler, *args)
+        finally:
+            # Each thread has its own database connection.
+            close_old_connections()
+
+    futures = [_handler_executor.submit(call, handler) for handler in handlers]
+    wait(futures)
+    return [future.result() for future in futures]
+
+
+async def gather_handlers(handlers, *args):
+    """
+    Await the given coroutine function handlers concurrently. If any
+    of them raise an exception, the first in the order given is raised
+    again once all of them have completed.
+    """
+    results = await asyncio.gather(
+        *[handler(*args) for handler in handlers], return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
+
+
+def place_order(request, order_form, order, payment_handler):
+    """
+    Run the final step of the checkout process. The items are first
+    removed from stock if ``SHOP_ORDER_ALLOW_NEGATIVE_STOCK`` is False,
+    and a use of the discount code is reserved, committed separately
+    so that the stock and discount code rows aren't locked during
+    payment. The order and its items are then created and the payment
+    handler called in a single transaction, so that if payment fails
+    with ``CheckoutError`` the order is rolled back, and the
+    reservations are returned before the error is raised again. If
+    payment fails with any other error, the card may have been charged,
+    so the order and its reservations are kept. Otherwise the order's
+    transaction ID is saved and the order is completed, so that a paid
+    order is always on record even if completing it fails.
+    """
+    # The discount code is set on the order from the session when it's
+    # set up, which happens after the reservations are made.
+    order.discount_code = request.session.get("discount_code", order.discount_code)
+    with transaction.atomic():
+        if not settings.SHOP_ORDER_ALLOW_NEGATIVE_STOCK:
+            if not order.remove_stock(request, allow_negative=False):
+                raise CheckoutError(_("Some items in your cart are out of stock."))
+        if not order.reserve_discount():
+            raise CheckoutError(_("The discount code entered is no longer valid."))
+    error = None
+    try:
+        with transaction.atomic():
+            order.setup(request)
+            try:
+                order.transaction_id = call_handler(
+                    payment_handler, request, order_form, order
+                )
+            except CheckoutError:
+                raise
+            except Exception as e:
+                # Keep the order, since the payment may have been taken,
+                # for example if the gateway timed out after charging.
+                error = e
+    except Exception:
+        # Setting up the order failed or payment was declined, so the
+        # order was rolled back, and the reservations are returned.
+        with transaction.atomic():
+            order.return_stock(request)
+            order.release_discount()
+        raise
+    if error is not None:
+        logger.error("Payment for order #%s failed", order.id, exc_info=error)
+        raise error
+    order.save(update_fields=["transaction_id"])
+    try:
+        with transaction.atomic():
+            order.complete(request)
+    except Exception:
+        logger.exception("Order #%s was paid but couldn't be completed", order.id)
+        raise
+    return order
+
+
 def initial_order_data(request, form_class=None):
     """
     Return the initial data for the order form, trying the following in
@@ -180,9 +428,21 @@ def initial_order_data(request, form_class=None):
 
 def send_order_email(request, order):
     """
-    Send order receipt email on successful order.
+    Send order receipt email on successful order, or queue it to be
+    sent by ``send_queued_order_emails`` if ``SHOP_ORDER_EMAIL_QUEUE``
+    is True.
     """
     settings.clear_cache()
+    if settings.SHOP_ORDER_EMAIL_QUEUE:
+        OrderEmail.objects.create(order=order)
+        return
+    _send_order_email(order, request)
+
+
+def _send_order_email(order, request=None, fail_silently=None):
+    """
+    Render and send the order receipt email.
+    """
     order_context = {
         "order": order,
         "request": request,
@@ -196,10 +456,33 @@ def send_order_email(request, order):
         settings.SHOP_ORDER_FROM_EMAIL,
         order.billing_detail_email,
         context=order_context,
+        fail_silently=fail_silently,
         addr_bcc=settings.SHOP_ORDER_EMAIL_BCC or None,
     )
 
 
+def send_queued_order_emails(limit=None):
+    """
+    Send the order receipt emails queued by ``send_order_email`` that
+    are due, recording any errors so that sending can be retried.
+    Returns the number of emails sent.
+    """
+    settings.clear_cache()
+    sent = 0
+    emails = OrderEmail.objects.due().select_related("order").order_by("id")
+    for email in emails[:limit]:
+        if not OrderEmail.objects.claim(email):
+            continue
+        try:
+            _send_order_email(email.order, fail_silently=False)
+        except Exception as e:
+            OrderEmail.objects.filter(id=email.id).update(error=str(e))
+        else:
+            OrderEmail.objects.filter(id=email.id).update(sent=now(), error="")
+            sent += 1
+    return sent
+
+
 # Set up some constants for identifying each checkout step.
 
 CHECKOUT_STEPS = [
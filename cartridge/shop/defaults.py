@@ -111,6 +111,58 @@ register_setting(
     default=30,
 )
 
+register_setting(
+    name="SHOP_CART_PURGE_BATCH_SIZE",
+    description="Number of expired carts deleted per batch when purging "
+    "expired carts.",
+    editable=False,
+    default=500,
+)
+
+register_setting(
+    name="SHOP_CART_PURGE_INTERVAL",
+    description="Minimum number of seconds between calls to the handler "
+    "defined by ``SHOP_HANDLER_CART_PURGE``.",
+    editable=False,
+    default=300,
+)
+
+register_setting(
+    name="SHOP_CART_PURGE_SLEEP",
+    description="Number of seconds to sleep between batches when purging "
+    "expired carts.",
+    editable=False,
+    default=0.1,
+)
+
+register_setting(
+    name="SHOP_CART_SNAPSHOT",
+    description="If True, the cart and its items are loaded together in a "
+    "single query on each request, and the cart's last updated time is "
+    "only written when the cart is modified, or when it's older than "
+    "``SHOP_CART_TOUCH_MINUTES``.",
+    editable=False,
+    default=False,
+)
+
+register_setting(
+    name="SHOP_CART_TOUCH_MINUTES",
+    description="When ``SHOP_CART_SNAPSHOT`` is True, number of minutes after "
+    "which an unmodified cart's last updated time is refreshed.",
+    editable=False,
+    default=5,
+)
+
+register_setting(
+    name="SHOP_CATEGORY_CACHE_SECONDS",
+    description="Number of seconds to cache the products for each page of a "
+    "category, per sort option. Cached pages are invalidated whenever a "
+    "product, variation, category or sale is saved or deleted. Set to 0 to "
+    "disable caching.",
+    editable=False,
+    default=0,
+)
+
 register_setting(
     name="SHOP_CATEGORY_USE_FEATURED_IMAGE",
     description=_("Enable featured images in shop categories"),
@@ -118,6 +170,19 @@ register_setting(
     default=False,
 )
 
+register_setting(
+    name="SHOP_CATEGORY_PRODUCT_INDEX",
+    description="If True, the products in each category, including those "
+    "matching the category's filters, are stored and kept up to date as "
+    "products, categories and sales change, so that category pages don't "
+    "evaluate the filters on each request. Run the "
+    "``update_category_products`` management command after enabling, and "
+    "periodically when sales or sale prices with start or end dates are "
+    "used, since the products matching those filters change over time.",
+    editable=False,
+    default=False,
+)
+
 register_setting(
     name="SHOP_CHECKOUT_ACCOUNT_REQUIRED",
     label=_("Checkout account required"),
@@ -126,6 +191,29 @@ register_setting(
     default=False,
 )
 
+register_setting(
+    name="SHOP_CHECKOUT_HANDLER_MEMO",
+    description="If True, the session variables set by the billing/shipping "
+    "and tax handlers are stored, and set again instead of calling the "
+    "handlers while the cart, address fields and discount are unchanged. "
+    "Only enable this if the handlers don't depend on anything else, such "
+    "as the user or other session variables.",
+    editable=False,
+    default=False,
+)
+
+register_setting(
+    name="SHOP_CHECKOUT_HANDLER_THREADS",
+    description="Number of threads used to call the billing/shipping and "
+    "tax handlers concurrently. If 0, the tax handler is called after the "
+    "billing/shipping handler, and can rely on the shipping it sets. "
+    "The threads use their own database connections, so the handlers are "
+    "called one after the other when a transaction is open, such as with "
+    "``ATOMIC_REQUESTS``.",
+    editable=False,
+    default=0,
+)
+
 register_setting(
     name="SHOP_CHECKOUT_STEPS_SPLIT",
     description="If True, the checkout process is split into separate "
@@ -177,6 +265,25 @@ register_setting(
     default=0.0,
 )
 
+register_setting(
+    name="SHOP_DISCOUNT_CODE_CACHE_SECONDS",
+    description="Number of seconds to cache discount codes when they're "
+    "entered, and whether any discount codes are active. Cached codes are "
+    "invalidated when discount codes change, but the number of uses "
+    "remaining may be out of date until they expire. Set to 0 to disable "
+    "caching.",
+    editable=False,
+    default=0,
+)
+
+register_setting(
+    name="SHOP_DISCOUNT_CODE_MISS_SECONDS",
+    description="When ``SHOP_DISCOUNT_CODE_CACHE_SECONDS`` is set, number "
+    "of seconds to cache that an entered discount code doesn't exist.",
+    editable=False,
+    default=30,
+)
+
 register_setting(
     name="SHOP_DISCOUNT_FIELD_IN_CART",
     label=_("Discount in Cart"),
@@ -204,6 +311,36 @@ register_setting(
     default="cartridge.shop.checkout.default_billship_handler",
 )
 
+register_setting(
+    name="SHOP_HANDLER_CART_PURGE",
+    label=_("Cart Purge Handler"),
+    description="Dotted package path and name of the function called at "
+    "most every ``SHOP_CART_PURGE_INTERVAL`` seconds while carts are in "
+    "use. This is where purging expired carts can be scheduled outside of "
+    "the request, eg by queueing a task that calls "
+    "``Cart.objects.purge_expired()``. The handler should only queue the "
+    "work, since it's called during the request. If empty, expired carts "
+    "are only purged by the ``purge_carts`` management command, which "
+    "should then be scheduled to run regularly, since the stock held by "
+    "the items in expired carts isn't released until they're purged.",
+    editable=False,
+    default="",
+)
+
+register_setting(
+    name="SHOP_HANDLER_SALE_UPDATE",
+    label=_("Sale Update Handler"),
+    description="Dotted package path and name of the function called with "
+    "a sale's ID once changes to the sale are committed. This is where "
+    "applying the sale to its products can be moved outside of the "
+    "request, eg by queueing a task that calls "
+    "``Sale.objects.run_update(sale_id)``. If empty, the sale is applied "
+    "as soon as the changes are committed, unless "
+    "``SHOP_SALE_UPDATE_QUEUE`` is True.",
+    editable=False,
+    default="",
+)
+
 register_setting(
     name="SHOP_HANDLER_TAX",
     label=_("Tax Handler"),
@@ -236,6 +373,18 @@ register_setting(
     default="cartridge.shop.checkout.default_payment_handler",
 )
 
+register_setting(
+    name="SHOP_KEYSET_PAGINATION",
+    description="If True, category pages and order history are paginated "
+    "using next and previous links that filter on the sort field of the "
+    "last or first item of the current page, rather than counting all "
+    "items and using an offset, so that later pages are as fast to "
+    "retrieve as the first. ``SHOP_CATEGORY_CACHE_SECONDS`` doesn't apply "
+    "when this is enabled.",
+    editable=False,
+    default=False,
+)
+
 register_setting(
     name="SHOP_OPTION_TYPE_CHOICES",
     description="Sequence of value/name pairs for types of product options "
@@ -282,6 +431,33 @@ register_setting(
     default="",
 )
 
+register_setting(
+    name="SHOP_ORDER_EMAIL_QUEUE",
+    description="If True, order receipt emails are queued rather than sent "
+    "during checkout, and are sent by the ``send_order_emails`` management "
+    "command, which should be run periodically.",
+    editable=False,
+    default=False,
+)
+
+register_setting(
+    name="SHOP_ORDER_EMAIL_MAX_ATTEMPTS",
+    description="When ``SHOP_ORDER_EMAIL_QUEUE`` is True, number of times "
+    "sending a queued order receipt email is attempted before giving up. "
+    "The delay between attempts doubles each time, starting at one minute.",
+    editable=False,
+    default=5,
+)
+
+register_setting(
+    name="SHOP_ORDER_ALLOW_NEGATIVE_STOCK",
+    description="If False, an order's items are removed from stock before "
+    "the payment handler is called, and the order fails if any item's "
+    "stock would go below zero. Stock is returned if payment fails.",
+    editable=False,
+    default=True,
+)
+
 register_setting(
     name="SHOP_ORDER_STATUS_CHOICES",
     description="Sequence of value/name pairs for order statuses.",
@@ -292,6 +468,39 @@ register_setting(
     ),
 )
 
+register_setting(
+    name="SHOP_PAYMENT_CONNECT_TIMEOUT",
+    description="Number of seconds to wait when connecting to a payment "
+    "gateway before giving up.",
+    editable=False,
+    default=5,
+)
+
+register_setting(
+    name="SHOP_PAYMENT_MAX_RETRIES",
+    description="Number of times a request to a payment gateway is retried "
+    "when it fails before being sent, or when it fails and is safe to "
+    "repeat.",
+    editable=False,
+    default=2,
+)
+
+register_setting(
+    name="SHOP_PAYMENT_POOL_SIZE",
+    description="Number of idle connections kept open to each payment "
+    "gateway host for reuse.",
+    editable=False,
+    default=4,
+)
+
+register_setting(
+    name="SHOP_PAYMENT_READ_TIMEOUT",
+    description="Number of seconds to wait for a payment gateway to respond "
+    "before giving up.",
+    editable=False,
+    default=30,
+)
+
 register_setting(
     name="SHOP_PER_PAGE_CATEGORY",
     label=_("Products Per Category Page"),
@@ -300,19 +509,68 @@ register_setting(
     default=12,
 )
 
+register_setting(
+    name="SHOP_PRODUCT_ACTION_BUFFER_SIZE",
+    description="Number of product actions (adding to cart and purchasing) "
+    "buffered in memory by each process before they're written to the "
+    "database in a batch. If zero, each action is written immediately.",
+    editable=False,
+    default=0,
+)
+
+register_setting(
+    name="SHOP_PRODUCT_ACTION_BUFFER_SECONDS",
+    description="Maximum number of seconds product actions are buffered "
+    "for when ``SHOP_PRODUCT_ACTION_BUFFER_SIZE`` is set.",
+    editable=False,
+    default=60,
+)
+
+register_setting(
+    name="SHOP_PRODUCT_CACHE_SECONDS",
+    description="Number of seconds to cache the data for each product's "
+    "page that's derived from its variations, images and related products. "
+    "Cached data is invalidated whenever a product, variation, image or "
+    "sale is saved or deleted, but not when a sale starts or ends, so sale "
+    "prices may lag by up to this long. Set to 0 to disable caching.",
+    editable=False,
+    default=0,
+)
+
 register_setting(
     name="SHOP_PRODUCT_SORT_OPTIONS",
     description="Sequence of description/field+direction pairs defining "
-    "the options available for sorting a list of products.",
+    "the options available for sorting a list of products. "
+    "``effective_price`` sorts by the price shown for each product, which "
+    "takes into account its sale price and the current sales.",
     editable=False,
     default=(
         (_("Recently added"), "-date_added"),
         (_("Highest rated"), "-rating_average"),
-        (_("Least expensive"), "unit_price"),
-        (_("Most expensive"), "-unit_price"),
+        (_("Least expensive"), "effective_price"),
+        (_("Most expensive"), "-effective_price"),
     ),
 )
 
+register_setting(
+    name="SHOP_SALE_UPDATE_QUEUE",
+    description="If True, and ``SHOP_HANDLER_SALE_UPDATE`` isn't set, sales "
+    "are queued rather than applied to their products when changes to them "
+    "are committed, and are applied by the ``apply_sales`` management "
+    "command, which should be run periodically.",
+    editable=False,
+    default=False,
+)
+
+register_setting(
+    name="SHOP_SALE_UPDATE_BATCH_SIZE",
+    description="Number of products or variations updated per query when "
+    "applying a sale on MySQL, which doesn't allow updating a table "
+    "filtered by a subquery on the same table.",
+    editable=False,
+    default=1000,
+)
+
 register_setting(
     name="SHOP_TAX_INCLUDED",
     label=_("Tax included"),
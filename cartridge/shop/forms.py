@@ -11,6 +11,7 @@ from django.forms.models import (
     ModelFormMetaclass,
     inlineformset_factory,
 )
+from django.utils.functional import cached_property
 from django.utils.safestring import mark_safe
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
@@ -76,24 +77,13 @@ class AddProductForm(forms.Form):
         option_fields = ProductVariation.option_fields()
         if not option_fields:
             return
-        option_names, option_labels = list(
-            zip(*[(f.name, f.verbose_name) for f in option_fields])
-        )
-        option_values = list(
-            zip(
-                *self._product.variations.filter(unit_price__isnull=False).values_list(
-                    *option_names
+        option_choices = self._product.page_payload()["option_choices"]
+        for field in option_fields:
+            values = option_choices.get(field.name)
+            if values:
+                self.fields[field.name] = forms.ChoiceField(
+                    label=field.verbose_name, choices=make_choices(values)
                 )
-            )
-        )
-        if option_values:
-            for i, name in enumerate(option_names):
-                values = [_f for _f in set(option_values[i]) if _f]
-                if values:
-                    field = forms.ChoiceField(
-                        label=option_labels[i], choices=make_choices(values)
-                    )
-                    self.fields[name] = field
 
     def clean(self):
         """
@@ -118,7 +108,10 @@ class AddProductForm(forms.Form):
             # A product hasn't been given since we have a direct sku.
             qs = ProductVariation.objects
         try:
-            variation = qs.get(**data)
+            # The variation's price is resolved the same way as when
+            # listing products, so that the price added to the cart
+            # matches the price shown.
+            variation = qs.with_effective_price().get(**data)
         except ProductVariation.DoesNotExist:
             error = "invalid_options"
         else:
@@ -146,11 +139,22 @@ class CartItemForm(forms.ModelForm):
         model = CartItem
         fields = ("quantity",)
 
+    def __init__(self, *args, **kwargs):
+        """
+        Variations for the cart's items may be given by the formset,
+        otherwise the item's variation is queried for when validated.
+        """
+        self._variations = kwargs.pop("variations", {})
+        super().__init__(*args, **kwargs)
+
     def clean_quantity(self):
         """
         Validate that the given quantity is available.
         """
-        variation = ProductVariation.objects.get(sku=self.instance.sku)
+        try:
+            variation = self._variations[self.instance.sku]
+        except KeyError:
+            variation = ProductVariation.objects.get(sku=self.instance.sku)
         quantity = self.cleaned_data["quantity"]
         if not variation.has_stock(quantity - self.instance.quantity):
             error = ADD_PRODUCT_ERRORS["no_stock_quantity"].rstrip(".")
@@ -158,8 +162,32 @@ class CartItemForm(forms.ModelForm):
         return quantity
 
 
+class BaseCartItemFormSet(BaseInlineFormSet):
+    """
+    Loads the variations for all items in the cart with a single
+    query, for validating stock in each ``CartItemForm``.
+    """
+
+    @cached_property
+    def variations(self):
+        skus = [item.sku for item in self.get_queryset()]
+        variations = ProductVariation.objects.filter(sku__in=skus)
+        return {variation.sku: variation for variation in variations}
+
+    def get_form_kwargs(self, index):
+        kwargs = super().get_form_kwargs(index)
+        if self.is_bound:
+            kwargs["variations"] = self.variations
+        return kwargs
+
+
 CartItemFormSet = inlineformset_factory(
-    Cart, CartItem, form=CartItemForm, can_delete=True, extra=0
+    Cart,
+    CartItem,
+    form=CartItemForm,
+    formset=BaseCartItemFormSet,
+    can_delete=True,
+    extra=0,
 )
 
 
@@ -393,7 +421,7 @@ class OrderForm(FormsetForm, DiscountForm):
         settings.clear_cache()
         if not (
             settings.SHOP_DISCOUNT_FIELD_IN_CHECKOUT
-            and DiscountCode.objects.active().exists()
+            and DiscountCode.objects.any_active()
         ):
             self.fields["discount_code"].widget = forms.HiddenInput()
 
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+
+from cartridge.shop.models import Sale
+
+
+class Command(BaseCommand):
+    help = _("Apply pending and queued sales to their products.")
+
+    def handle(self, *args, **options):
+        total = Sale.objects.run_queued()
+        self.stdout.write(_("Applied %s sales.") % total)
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+
+from cartridge.shop.models import Cart
+
+
+class Command(BaseCommand):
+    help = _("Delete expired carts in batches.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            dest="batch_size",
+            default=None,
+            help=_("Number of carts to delete per batch."),
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            dest="sleep",
+            default=None,
+            help=_("Number of seconds to sleep between batches."),
+        )
+
+    def handle(self, *args, **options):
+        total = Cart.objects.purge_expired(
+            batch_size=options["batch_size"], sleep=options["sleep"]
+        )
+        self.stdout.write(_("Deleted %s expired carts.") % total)
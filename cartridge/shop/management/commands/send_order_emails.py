@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+
+from cartridge.shop.checkout import send_queued_order_emails
+
+
+class Command(BaseCommand):
+    help = _("Send queued order receipt emails.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit",
+            type=int,
+            dest="limit",
+            default=None,
+            help=_("Maximum number of emails to send."),
+        )
+
+    def handle(self, *args, **options):
+        total = send_queued_order_emails(limit=options["limit"])
+        self.stdout.write(_("Sent %s order emails.") % total)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import gettext as _
+from mezzanine.conf import settings
+
+from cartridge.shop.models import Category, CategoryProduct
+
+
+class Command(BaseCommand):
+    help = _("Store the products for each category, including filtered products.")
+
+    def handle(self, *args, **options):
+        if not settings.SHOP_CATEGORY_PRODUCT_INDEX:
+            raise CommandError(_("SHOP_CATEGORY_PRODUCT_INDEX is not enabled."))
+        categories = Category.objects.all()
+        CategoryProduct.objects.update_for_categories(categories)
+        self.stdout.write(_("Updated %s categories.") % len(categories))
@@ -1,41 +1,117 @@
+import atexit
 from collections import OrderedDict, defaultdict
 from datetime import datetime, timedelta
+from hashlib import md5
+from threading import Lock
+from time import monotonic
+from time import sleep as sleep_for
 
-from django.db.models import Manager, Q
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import (
+    Case,
+    CharField,
+    DecimalField,
+    Exists,
+    ExpressionWrapper,
+    F,
+    IntegerField,
+    Manager,
+    OuterRef,
+    Q,
+    QuerySet,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Coalesce
 from django.utils.timezone import now
 from mezzanine.conf import settings
-from mezzanine.core.managers import CurrentSiteManager
+from mezzanine.core.managers import (
+    CurrentSiteManager,
+    DisplayableManager,
+    SearchableQuerySet,
+)
+from mezzanine.utils.importing import import_dotted_path
+
+from cartridge.shop.utils import discount_version, schedule_cart_purge
 
 
 class CartManager(Manager):
     def from_request(self, request):
         """
         Return a cart by ID stored in the session, updating its last_updated
-        value and removing old carts. A new cart will be created (but not
+        value and scheduling old carts to be purged. A new cart will be created (but not
         persisted in the database) if the session cart is expired or missing.
         """
         cart_id = request.session.get("cart", None)
+        if settings.SHOP_CART_SNAPSHOT:
+            return self._snapshot_from_request(request, cart_id)
         cart = self.current().filter(id=cart_id)
         last_updated = now()
 
-        # Update timestamp and clear out old carts.
+        # Update timestamp and schedule clearing out old carts.
         if cart_id and cart.update(last_updated=last_updated):
-            self.expired().delete()
+            schedule_cart_purge()
         elif cart_id:
-            # Cart has expired. Delete the cart id and
-            # forget what checkout step we were up to.
-            del request.session["cart"]
+            self._forget(request)
             cart_id = None
-            try:
-                del request.session["order"]["step"]
-            except KeyError:
-                pass
 
         # This is a cheeky way to save a database call: since Cart only has
         # two fields and we know both of their values, we can simply create
         # a cart instance without taking a trip to the database via the ORM.
         return self.model(id=cart_id, last_updated=last_updated)
 
+    def _snapshot_from_request(self, request, cart_id):
+        """
+        Version of ``from_request`` used when ``SHOP_CART_SNAPSHOT`` is
+        True. The cart and its items are loaded together in a single
+        query and cached on the cart, so iterating it and calling its
+        template helpers doesn't touch the database. The cart's
+        last_updated value is only written when it's older than
+        ``SHOP_CART_TOUCH_MINUTES``, and by ``recalculate_cart`` when
+        the cart has been modified.
+        """
+        cart = None
+        items = []
+        if cart_id:
+            item_model = self.model._meta.get_field("items").related_model
+            lookup = {"cart_id": cart_id, "cart__last_updated__gte": self.expiry_time()}
+            items = list(item_model.objects.filter(**lookup).select_related("cart"))
+            if items:
+                cart = items[0].cart
+            else:
+                # No items, so check the cart itself is still current.
+                cart = self.current().filter(id=cart_id).first()
+            if cart is None:
+                self._forget(request)
+        last_updated = now()
+        if cart is None:
+            cart = self.model(last_updated=last_updated)
+        else:
+            touch_time = timedelta(minutes=settings.SHOP_CART_TOUCH_MINUTES)
+            if cart.last_updated < last_updated - touch_time:
+                # Update timestamp and schedule clearing out old carts.
+                self.filter(id=cart.id).update(last_updated=last_updated)
+                cart.last_updated = last_updated
+                schedule_cart_purge()
+        for item in items:
+            item.cart = cart
+        cart._cached_items = items
+        return cart
+
+    def _forget(self, request):
+        """
+        Cart has expired. Delete the cart id and forget what checkout
+        step we were up to.
+        """
+        del request.session["cart"]
+        try:
+            del request.session["order"]["step"]
+        except KeyError:
+            pass
+
     def expiry_time(self):
         """
         Datetime for expired carts.
@@ -54,6 +130,53 @@ class CartManager(Manager):
         """
         return self.filter(last_updated__lt=self.expiry_time())
 
+    def purge_expired(self, batch_size=None, sleep=None):
+        """
+        Delete expired carts and their items in batches chunked by ID,
+        sleeping between batches so that other queries against the
+        cart tables aren't held up. Defaults to the
+        ``SHOP_CART_PURGE_BATCH_SIZE`` and ``SHOP_CART_PURGE_SLEEP``
+        settings. Returns the number of carts deleted.
+        """
+        if batch_size is None:
+            batch_size = settings.SHOP_CART_PURGE_BATCH_SIZE
+        if sleep is None:
+            sleep = settings.SHOP_CART_PURGE_SLEEP
+        expired = self.expired()
+        total = 0
+        last_id = 0
+        while True:
+            batch = expired.filter(id__gt=last_id).order_by("id")
+            batch_ids = list(batch.values_list("id", flat=True)[:batch_size])
+            if not batch_ids:
+                break
+            last_id = batch_ids[-1]
+            # Filtering by expiry again guards against deleting carts
+            # that have been updated since the batch was selected.
+            with transaction.atomic(using=self.db):
+                carts = expired.filter(id__in=batch_ids).select_for_update()
+                ids = list(carts.values_list("id", flat=True))
+                self.release_stock(ids)
+                _, deleted = self.filter(id__in=ids).delete()
+            total += deleted.get(self.model._meta.label, 0)
+            if len(batch_ids) < batch_size:
+                break
+            if sleep:
+                sleep_for(sleep)
+        return total
+
+    def release_stock(self, cart_ids):
+        """
+        Release the stock held against variations by the items in the
+        given carts, prior to the carts being deleted.
+        """
+        from cartridge.shop.models import ProductVariation
+
+        item_model = self.model._meta.get_field("items").related_model
+        items = item_model.objects.filter(cart_id__in=cart_ids)
+        quantities = items.values_list("sku").annotate(Sum("quantity")).order_by()
+        ProductVariation.objects.reserve({sku: -total for sku, total in quantities})
+
 
 class OrderManager(CurrentSiteManager):
     def from_request(self, request):
@@ -80,6 +203,184 @@ class OrderManager(CurrentSiteManager):
         return self.get(**lookup)
 
 
+def annotate_effective_price(queryset, sale_price):
+    """
+    Annotate the queryset with ``effective_price``, the price given by
+    ``Priced.price``: the lower of the stored sale price if it's set
+    and within its date range, and ``sale_price``, the lowest price
+    given by the current sales, otherwise the unit price. Both prices
+    are annotated first so that they can be compared using lookups.
+    """
+    n = now()
+    on_sale = Q(sale_price__isnull=False)
+    on_sale &= Q(sale_from__isnull=True) | Q(sale_from__lt=n)
+    on_sale &= Q(sale_to__isnull=True) | Q(sale_to__gt=n)
+    queryset = queryset.annotate(
+        lowest_sale_price=sale_price,
+        stored_sale_price=Case(
+            When(on_sale, then="sale_price"), output_field=DecimalField()
+        ),
+    )
+    stored = F("stored_sale_price")
+    price = Case(
+        When(
+            Q(stored_sale_price__isnull=True),
+            then=Coalesce(
+                "lowest_sale_price", "unit_price", output_field=DecimalField()
+            ),
+        ),
+        When(Q(lowest_sale_price__isnull=True), then=stored),
+        When(Q(stored_sale_price__lt=F("lowest_sale_price")), then=stored),
+        default=F("lowest_sale_price"),
+        output_field=DecimalField(),
+    )
+    return queryset.annotate(effective_price=price)
+
+
+class ProductQuerySet(SearchableQuerySet):
+    def with_stock(self):
+        """
+        Annotate products with ``in_stock``, which is True if any of
+        the product's variations have live stock, so that stock can be
+        shown when listing products without querying each of them.
+        """
+        variation_model = self.model._meta.get_field("variations").related_model
+        variations = variation_model.objects.filter(product=OuterRef("pk"))
+        in_stock = Q(live_stock__isnull=True) | Q(live_stock__gt=0)
+        variations = variations.with_live_stock().filter(in_stock)
+        return self.annotate(in_stock=Exists(variations))
+
+    def with_effective_price(self):
+        """
+        Annotate products with ``effective_price``, the lowest of their
+        own sale price and the prices given by the sales currently
+        applying to them, or the unit price. This is resolved when
+        querying, so takes into account overlapping sales and their
+        date ranges, and is then used by ``Priced.on_sale`` and
+        ``Priced.price``, and for sorting products by price.
+        """
+        sale_model = self.model._meta.get_field("sale_products").related_model
+        sale_model = sale_model._meta.get_field("sale").related_model
+        sale_price = sale_model.objects.lowest_price("pk")
+        return annotate_effective_price(self, sale_price)
+
+
+class ProductManager(DisplayableManager.from_queryset(ProductQuerySet)):
+    def get_queryset(self):
+        """
+        Use ``ProductQuerySet`` in place of Mezzanine's
+        ``SearchableQuerySet`` which it extends.
+        """
+        queryset = super().get_queryset()
+        return ProductQuerySet(
+            self.model,
+            query=queryset.query,
+            using=queryset.db,
+            search_fields=self.get_search_fields(),
+        )
+
+
+class CategoryProductManager(Manager):
+    def _categories(self):
+        """
+        Categories whose products are stored in the table.
+        """
+        return self.model._meta.get_field("category").related_model.objects
+
+    def _update(self, category, matched, product_ids=None):
+        """
+        Add and remove rows for the category so that its products are
+        the matched product IDs, optionally limited to the given
+        product IDs.
+        """
+        current = self.filter(category=category)
+        if product_ids is not None:
+            current = current.filter(product_id__in=product_ids)
+        existing = set(current.values_list("product_id", flat=True))
+        if existing - matched:
+            current.filter(product_id__in=existing - matched).delete()
+        self.bulk_create(
+            [self.model(category=category, product_id=i) for i in matched - existing],
+            ignore_conflicts=True,
+        )
+
+    def update_for_categories(self, categories):
+        """
+        Store the products matching the filters for each of the given
+        categories.
+        """
+        if not settings.SHOP_CATEGORY_PRODUCT_INDEX:
+            return
+        product_model = self.model._meta.get_field("product").related_model
+        for category in categories:
+            products = product_model._base_manager.filter(site_id=category.site_id)
+            products = products.filter(category.filters()).distinct()
+            self._update(category, set(products.values_list("id", flat=True)))
+
+    def update_for_products(self, product_ids):
+        """
+        Update the categories the given products belong to. Only
+        categories with filters, or that the products are or were
+        explicitly assigned to, are checked.
+        """
+        if not settings.SHOP_CATEGORY_PRODUCT_INDEX:
+            return
+        product_model = self.model._meta.get_field("product").related_model
+        categories = self._categories().filter(
+            Q(options__isnull=False)
+            | Q(sale__isnull=False)
+            | Q(price_min__isnull=False)
+            | Q(price_max__isnull=False)
+            | Q(products__in=product_ids)
+            | Q(category_products__product_id__in=product_ids)
+        )
+        for category in categories.distinct():
+            products = product_model._base_manager.filter(id__in=product_ids)
+            products = products.filter(category.filters()).distinct()
+            matched = set(products.values_list("id", flat=True))
+            self._update(category, matched, product_ids)
+
+    def categories_for_sale(self, sale):
+        """
+        Categories filtered by the given sale, or by price, since the
+        sale changes the sale price of products.
+        """
+        return self._categories().filter(
+            Q(sale=sale) | Q(price_min__isnull=False) | Q(price_max__isnull=False)
+        )
+
+    def update_for_sale(self, sale):
+        """
+        Update the categories affected by the given sale.
+        """
+        self.update_for_categories(self.categories_for_sale(sale))
+
+
+class OrderEmailManager(Manager):
+    def due(self):
+        """
+        Unsent emails that are due to be sent, and haven't reached
+        ``SHOP_ORDER_EMAIL_MAX_ATTEMPTS``.
+        """
+        return self.filter(
+            sent__isnull=True,
+            next_attempt__lte=now(),
+            attempts__lt=settings.SHOP_ORDER_EMAIL_MAX_ATTEMPTS,
+        )
+
+    def claim(self, email):
+        """
+        Record an attempt at sending the email, and schedule the next
+        attempt with an exponential backoff in case it fails. Returns
+        False if the email was claimed by another worker first.
+        """
+        next_attempt = now() + timedelta(minutes=2**email.attempts)
+        claimed = self.filter(id=email.id, attempts=email.attempts).update(
+            attempts=F("attempts") + 1, next_attempt=next_attempt
+        )
+        return claimed > 0
+
+
 class ProductOptionManager(Manager):
     def as_fields(self):
         """
@@ -92,7 +393,29 @@ class ProductOptionManager(Manager):
         return options
 
 
-class ProductVariationManager(Manager):
+class ProductVariationQuerySet(QuerySet):
+    def with_live_stock(self):
+        """
+        Annotate variations with ``live_stock``, the same value as
+        ``ProductVariation.live_num_in_stock``, so that stock for many
+        variations can be filtered on with a single query.
+        """
+        return self.annotate(live_stock=F("num_in_stock") - F("num_in_carts"))
+
+    def with_effective_price(self):
+        """
+        Annotate variations with ``effective_price``, resolved from the
+        sales currently applying to their product, as described in
+        ``ProductQuerySet.with_effective_price``.
+        """
+        product_model = self.model._meta.get_field("product").related_model
+        sale_model = product_model._meta.get_field("sale_products").related_model
+        sale_model = sale_model._meta.get_field("sale").related_model
+        sale_price = sale_model.objects.lowest_price("product_id")
+        return annotate_effective_price(self, sale_price)
+
+
+class ProductVariationManager(Manager.from_queryset(ProductVariationQuerySet)):
 
     use_for_related_fields = True
 
@@ -148,6 +471,52 @@ class ProductVariationManager(Manager):
             first_variation.default = True
             first_variation.save()
 
+    def reserve(self, quantities):
+        """
+        Adjust the number in carts for variations, given a dict of SKUs
+        mapped to quantities, with negative quantities releasing stock.
+        """
+        for sku, quantity in quantities.items():
+            if quantity:
+                num_in_carts = F("num_in_carts") + quantity
+                self.filter(sku=sku).update(num_in_carts=num_in_carts)
+
+    def update_stock(self, quantities, allow_negative=True):
+        """
+        Adjust the number in stock for variations with stock control,
+        given a dict of SKUs mapped to quantities, using a single
+        atomic update rather than reading and saving each variation.
+        The denormalised number in stock for products is then synced
+        from their default variations. If ``allow_negative`` is False
+        and any variation's stock would go below zero, no stock is
+        changed and False is returned.
+        """
+        quantities = {sku: quantity for sku, quantity in quantities.items() if quantity}
+        if not quantities:
+            return True
+        variations = self.filter(sku__in=list(quantities), num_in_stock__isnull=False)
+        num_in_stock = Case(
+            *[
+                When(sku=sku, then=F("num_in_stock") + quantity)
+                for sku, quantity in quantities.items()
+            ],
+            default=F("num_in_stock"),
+            output_field=IntegerField(),
+        )
+        with transaction.atomic(using=self.db):
+            variations.update(num_in_stock=num_in_stock)
+            if not allow_negative and variations.filter(num_in_stock__lt=0).exists():
+                transaction.set_rollback(True, using=self.db)
+                return False
+            product_model = self.model._meta.get_field("product").related_model
+            default = self.model.objects.filter(product=OuterRef("pk"), default=True)
+            default_num_in_stock = Subquery(default.values("num_in_stock")[:1])
+            products = product_model._base_manager.filter(
+                variations__in=variations.filter(default=True)
+            )
+            products.update(num_in_stock=default_num_in_stock)
+        return True
+
     def set_default_images(self, deleted_image_ids):
         """
         Assign the first image for the product to each variation that
@@ -172,6 +541,55 @@ class ProductVariationManager(Manager):
                 variation.save()
 
 
+class ProductActionBuffer:
+    """
+    Accumulates increments for ``ProductAction`` fields in process
+    memory, keyed by product and day, when
+    ``SHOP_PRODUCT_ACTION_BUFFER_SIZE`` is set. The increments are
+    written in a batch once the buffer size is reached, or
+    ``SHOP_PRODUCT_ACTION_BUFFER_SECONDS`` have passed since the last
+    write, and any remaining when the process exits.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.model = None
+        self.reset()
+
+    def reset(self):
+        self.counts = defaultdict(lambda: defaultdict(int))
+        self.size = 0
+        self.flushed = monotonic()
+
+    def add(self, model, product_id, timestamp, field):
+        """
+        Buffer an increment, flushing the buffer if it's full or due.
+        """
+        with self.lock:
+            self.model = model
+            self.counts[(product_id, timestamp)][field] += 1
+            self.size += 1
+            full = self.size >= settings.SHOP_PRODUCT_ACTION_BUFFER_SIZE
+            elapsed = monotonic() - self.flushed
+            if not full and elapsed < settings.SHOP_PRODUCT_ACTION_BUFFER_SECONDS:
+                return
+        self.flush()
+
+    def flush(self):
+        """
+        Write all buffered increments.
+        """
+        with self.lock:
+            counts = self.counts
+            self.reset()
+        if counts:
+            self.model.objects.increment(counts)
+
+
+action_buffer = ProductActionBuffer()
+atexit.register(action_buffer.flush)
+
+
 class ProductActionManager(Manager):
 
     use_for_related_fields = True
@@ -183,10 +601,33 @@ class ProductActionManager(Manager):
         determine popularity over time.
         """
         timestamp = datetime.today().toordinal()
+        if settings.SHOP_PRODUCT_ACTION_BUFFER_SIZE:
+            product_id = self.instance.id
+            action_buffer.add(self.model, product_id, timestamp, field)
+            return
         action, created = self.get_or_create(timestamp=timestamp)
         setattr(action, field, getattr(action, field) + 1)
         action.save()
 
+    def increment(self, counts):
+        """
+        Given a dict of (product ID, timestamp) pairs mapped to dicts
+        of field names and amounts, increase each action's fields with
+        a single update, creating the action if it doesn't exist yet.
+        Used for writing ``ProductActionBuffer`` increments.
+        """
+        for (product_id, timestamp), amounts in counts.items():
+            lookup = {"product_id": product_id, "timestamp": timestamp}
+            update = {field: F(field) + amount for field, amount in amounts.items()}
+            if self.filter(**lookup).update(**update):
+                continue
+            try:
+                with transaction.atomic(using=self.db):
+                    self.create(**lookup, **amounts)
+            except IntegrityError:
+                # Created concurrently, or the product no longer exists.
+                self.filter(**lookup).update(**update)
+
     def added_to_cart(self):
         """
         Increase total_cart when product is added to cart.
@@ -200,6 +641,147 @@ class ProductActionManager(Manager):
         self._action_for_field("total_purchase")
 
 
+class SaleQuerySet(QuerySet):
+    def current(self):
+        """
+        Sales flagged as active and in valid date range if date(s) are
+        specified.
+        """
+        n = now()
+        valid_from = Q(valid_from__isnull=True) | Q(valid_from__lte=n)
+        valid_to = Q(valid_to__isnull=True) | Q(valid_to__gte=n)
+        return self.filter(valid_from, valid_to, active=True)
+
+    def lowest_price(self, product):
+        """
+        Return a subquery for the lowest price given by the current
+        sales for the product referenced by ``product`` in the outer
+        query, applied to the outer query's ``unit_price``, matching
+        the prices ``Sale.update_products`` stores.
+        """
+        unit_price = OuterRef("unit_price")
+        # Divide by "100.0" as ``Sale.update_products`` does, so that
+        # percentages of whole prices aren't truncated by integer
+        # division, which casting to a decimal doesn't prevent on SQLite.
+        one_percent = ExpressionWrapper(
+            unit_price / Value("100.0"), output_field=DecimalField()
+        )
+        no_deduct = Q(discount_deduct__isnull=True)
+        price = Case(
+            When(
+                discount_deduct__lt=unit_price,
+                then=unit_price - F("discount_deduct"),
+            ),
+            When(
+                no_deduct & Q(discount_percent__isnull=False),
+                then=unit_price - one_percent * F("discount_percent"),
+            ),
+            When(
+                no_deduct
+                & Q(discount_percent__isnull=True)
+                & Q(discount_exact__lt=unit_price),
+                then=F("discount_exact"),
+            ),
+            output_field=DecimalField(),
+        )
+        sales = self.current().filter(sale_products__product=OuterRef(product))
+        sales = sales.annotate(price=price).filter(price__isnull=False)
+        return Subquery(sales.order_by("price").values("price")[:1])
+
+
+class SaleManager(Manager.from_queryset(SaleQuerySet)):
+    def schedule_update(self, sale_id):
+        """
+        Mark the sale as pending and apply it to its products once the
+        current transaction is committed, via the handler defined by
+        ``SHOP_HANDLER_SALE_UPDATE`` if one is configured. Multiple
+        changes to a sale within the same transaction, such as saving
+        it along with its products and categories in the admin, result
+        in the sale only being applied once. If the sale is currently
+        being applied, it's marked as changed instead, and applied
+        again once the current run finishes, so that two runs for the
+        same sale never overlap.
+        """
+        running = (self.model.UPDATE_RUNNING, self.model.UPDATE_CHANGED)
+        status = Case(
+            When(update_status__in=running, then=Value(self.model.UPDATE_CHANGED)),
+            default=Value(self.model.UPDATE_PENDING),
+            output_field=CharField(),
+        )
+        self.filter(id=sale_id).update(update_status=status)
+        transaction.on_commit(lambda: self._queue_update(sale_id))
+
+    def _queue_update(self, sale_id):
+        """
+        Queue the pending sale to be applied, unless a previous
+        callback for the same changes has already done so. If
+        ``SHOP_SALE_UPDATE_QUEUE`` is True, queued sales are left for
+        the ``apply_sales`` management command to apply.
+        """
+        pending = self.filter(id=sale_id, update_status=self.model.UPDATE_PENDING)
+        if pending.update(update_status=self.model.UPDATE_QUEUED):
+            if settings.SHOP_HANDLER_SALE_UPDATE:
+                import_dotted_path(settings.SHOP_HANDLER_SALE_UPDATE)(sale_id)
+            elif not settings.SHOP_SALE_UPDATE_QUEUE:
+                self.run_update(sale_id)
+
+    def run_update(self, sale_id):
+        """
+        Apply the sale to its products, recording its status and the
+        number of products and variations updated as it progresses.
+        Returns False if the sale has no pending update, such as when
+        the update was queued more than once, or it's already being
+        applied.
+        """
+        statuses = (self.model.UPDATE_PENDING, self.model.UPDATE_QUEUED)
+        claimed = self.filter(id=sale_id, update_status__in=statuses).update(
+            update_status=self.model.UPDATE_RUNNING, update_progress=0
+        )
+        if not claimed:
+            return False
+        sale = self.get(id=sale_id)
+        try:
+            sale.apply()
+        except Exception:
+            self.filter(id=sale_id).update(update_status=self.model.UPDATE_FAILED)
+            raise
+        running = self.filter(id=sale_id, update_status=self.model.UPDATE_RUNNING)
+        if not running.update(update_status=self.model.UPDATE_COMPLETE):
+            # The sale was changed while running, so queue it again to
+            # apply the latest changes.
+            changed = self.filter(id=sale_id, update_status=self.model.UPDATE_CHANGED)
+            changed.update(update_status=self.model.UPDATE_PENDING)
+            self._queue_update(sale_id)
+        return True
+
+    def run_queued(self):
+        """
+        Apply each sale that's pending or queued, such as when
+        ``SHOP_SALE_UPDATE_QUEUE`` is True, or a previous update was
+        interrupted before it ran. Returns the number of sales applied.
+        """
+        statuses = (self.model.UPDATE_PENDING, self.model.UPDATE_QUEUED)
+        sales = self.filter(update_status__in=statuses).order_by("id")
+        return sum(self.run_update(i) for i in sales.values_list("id", flat=True))
+
+
+class SaleProductManager(Manager):
+    def update_for_sale(self, sale):
+        """
+        Store the products the given sale applies to, which are then
+        used to resolve sale prices when querying.
+        """
+        matched = set(sale.all_products().values_list("id", flat=True))
+        current = self.filter(sale=sale)
+        existing = set(current.values_list("product_id", flat=True))
+        if existing - matched:
+            current.filter(product_id__in=existing - matched).delete()
+        self.bulk_create(
+            [self.model(sale=sale, product_id=i) for i in matched - existing],
+            ignore_conflicts=True,
+        )
+
+
 class DiscountCodeManager(Manager):
     def active(self, *args, **kwargs):
         """
@@ -212,17 +794,73 @@ class DiscountCodeManager(Manager):
         valid = self.filter(valid_from, valid_to, active=True)
         return valid.exclude(uses_remaining=0)
 
+    def any_active(self):
+        """
+        Returns True if there are any active discount codes, used for
+        deciding whether to show the discount code field. Cached for
+        ``SHOP_DISCOUNT_CODE_CACHE_SECONDS`` if set.
+        """
+        timeout = settings.SHOP_DISCOUNT_CODE_CACHE_SECONDS
+        if not timeout:
+            return self.active().exists()
+        cache_key = "cartridge-discount-codes-active-%s" % discount_version()
+        return cache.get_or_set(cache_key, self.active().exists, timeout)
+
+    def get_active(self, code):
+        """
+        Returns the discount code for the given code if it's active,
+        otherwise raises ``DoesNotExist``. If
+        ``SHOP_DISCOUNT_CODE_CACHE_SECONDS`` is set, discount codes are
+        cached and checked for being active in Python, and unknown
+        codes are cached for ``SHOP_DISCOUNT_CODE_MISS_SECONDS`` so
+        that repeatedly entering invalid codes doesn't query the
+        database each time.
+        """
+        timeout = settings.SHOP_DISCOUNT_CODE_CACHE_SECONDS
+        if not timeout:
+            return self.active().get(code=code)
+        code_hash = md5(code.encode("utf-8")).hexdigest()
+        cache_key = "cartridge-discount-code-%s-%s" % (discount_version(), code_hash)
+        discount = cache.get(cache_key)
+        if discount is None:
+            try:
+                discount = self.get(code=code)
+            except self.model.DoesNotExist:
+                discount = False
+                timeout = settings.SHOP_DISCOUNT_CODE_MISS_SECONDS
+            cache.set(cache_key, discount, timeout)
+        if not discount or not discount.is_active():
+            raise self.model.DoesNotExist
+        return discount
+
+    def reserve(self, code):
+        """
+        Decrement the uses remaining for the active discount code with
+        a single conditional update, so that concurrent orders can't
+        use it more times than allowed. Returns False if the code isn't
+        active or has no uses remaining.
+        """
+        uses = Q(uses_remaining__isnull=True) | Q(uses_remaining__gt=0)
+        codes = self.active().filter(uses, code=code)
+        return codes.update(uses_remaining=F("uses_remaining") - 1) > 0
+
+    def release(self, code):
+        """
+        Return a use of the discount code taken by ``reserve``.
+        """
+        codes = self.filter(code=code, uses_remaining__isnull=False)
+        codes.update(uses_remaining=F("uses_remaining") + 1)
+
     def get_valid(self, code, cart):
         """
         Items flagged as active and within date range as well checking
         that the given cart contains items that the code is valid for.
         """
-        total_price_valid = Q(min_purchase__isnull=True) | Q(
-            min_purchase__lte=cart.total_price()
-        )
-        discount = self.active().get(total_price_valid, code=code)
-        products = discount.all_products()
-        if products.exists():
-            if products.filter(variations__sku__in=cart.skus()).count() == 0:
-                raise self.model.DoesNotExist
+        discount = self.get_active(code)
+        min_purchase = discount.min_purchase
+        if min_purchase is not None and min_purchase > cart.total_price():
+            raise self.model.DoesNotExist
+        skus = discount.eligible_skus()
+        if skus is not None and skus.isdisjoint(cart.skus()):
+            raise self.model.DoesNotExist
         return discount
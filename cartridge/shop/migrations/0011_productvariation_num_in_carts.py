@@ -0,0 +1,33 @@
+# Generated by Django 4.1.13 on 2026-10-18 01:50
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def reserve_cart_stock(apps, schema_editor):
+    """
+    Set the number in carts for each variation from existing carts.
+    """
+    CartItem = apps.get_model("shop", "CartItem")
+    ProductVariation = apps.get_model("shop", "ProductVariation")
+    quantities = CartItem.objects.values_list("sku").annotate(Sum("quantity"))
+    for sku, quantity in quantities.order_by():
+        ProductVariation.objects.filter(sku=sku).update(num_in_carts=quantity)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("shop", "0010_alter_discountcode_categories_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="productvariation",
+            name="num_in_carts",
+            field=models.IntegerField(
+                default=0, editable=False, verbose_name="Number in carts"
+            ),
+        ),
+        migrations.RunPython(reserve_cart_stock, migrations.RunPython.noop),
+    ]
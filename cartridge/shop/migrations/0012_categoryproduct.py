@@ -0,0 +1,47 @@
+# Generated by Django 4.1.13 on 2026-10-18 01:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("shop", "0011_productvariation_num_in_carts"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CategoryProduct",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "category",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="category_products",
+                        to="shop.category",
+                    ),
+                ),
+                (
+                    "product",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="category_products",
+                        to="shop.product",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("category", "product")},
+            },
+        ),
+    ]
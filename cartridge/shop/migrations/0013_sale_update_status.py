@@ -0,0 +1,37 @@
+# Generated by Django 4.1.13 on 2026-10-18 02:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("shop", "0012_categoryproduct"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="sale",
+            name="update_progress",
+            field=models.IntegerField(
+                default=0, editable=False, verbose_name="Products updated"
+            ),
+        ),
+        migrations.AddField(
+            model_name="sale",
+            name="update_status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("queued", "Queued"),
+                    ("running", "Running"),
+                    ("complete", "Complete"),
+                    ("failed", "Failed"),
+                ],
+                default="complete",
+                editable=False,
+                max_length=20,
+                verbose_name="Update status",
+            ),
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 4.1.13 on 2026-10-18 02:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def store_sale_products(apps, schema_editor):
+    """
+    Store the products for sales from the sale applied to each product.
+    Sales that aren't currently applied are stored when next saved.
+    """
+    Product = apps.get_model("shop", "Product")
+    Sale = apps.get_model("shop", "Sale")
+    SaleProduct = apps.get_model("shop", "SaleProduct")
+    sale_ids = set(Sale.objects.values_list("id", flat=True))
+    products = Product.objects.filter(sale_id__in=sale_ids)
+    SaleProduct.objects.bulk_create(
+        [
+            SaleProduct(sale_id=s, product_id=p)
+            for p, s in products.values_list("id", "sale_id")
+        ]
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("shop", "0013_sale_update_status"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SaleProduct",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="sale",
+            index=models.Index(
+                fields=["active", "valid_from", "valid_to"],
+                name="shop_sale_active_218552_idx",
+            ),
+        ),
+        migrations.AddField(
+            model_name="saleproduct",
+            name="product",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="sale_products",
+                to="shop.product",
+            ),
+        ),
+        migrations.AddField(
+            model_name="saleproduct",
+            name="sale",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="sale_products",
+                to="shop.sale",
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="saleproduct",
+            unique_together={("product", "sale")},
+        ),
+        migrations.RunPython(store_sale_products, migrations.RunPython.noop),
+    ]
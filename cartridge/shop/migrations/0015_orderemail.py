@@ -0,0 +1,60 @@
+# Generated by Django 4.1.13 on 2026-10-18 02:18
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("shop", "0014_saleproduct"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OrderEmail",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("time", models.DateTimeField(auto_now_add=True, verbose_name="Time")),
+                (
+                    "sent",
+                    models.DateTimeField(blank=True, null=True, verbose_name="Sent"),
+                ),
+                ("attempts", models.IntegerField(default=0, verbose_name="Attempts")),
+                (
+                    "next_attempt",
+                    models.DateTimeField(
+                        default=django.utils.timezone.now, verbose_name="Next attempt"
+                    ),
+                ),
+                ("error", models.TextField(blank=True, verbose_name="Error")),
+                (
+                    "order",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="emails",
+                        to="shop.order",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Order email",
+                "verbose_name_plural": "Order emails",
+            },
+        ),
+        migrations.AddIndex(
+            model_name="orderemail",
+            index=models.Index(
+                fields=["sent", "next_attempt"], name="shop_ordere_sent_1ab473_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.1.13 on 2026-10-18 03:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("shop", "0015_orderemail"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="sale",
+            name="update_status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("queued", "Queued"),
+                    ("running", "Running"),
+                    ("changed", "Changed while running"),
+                    ("complete", "Complete"),
+                    ("failed", "Failed"),
+                ],
+                default="complete",
+                editable=False,
+                max_length=20,
+                verbose_name="Update status",
+            ),
+        ),
+    ]
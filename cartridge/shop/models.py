@@ -1,12 +1,16 @@
-from decimal import Decimal
+from decimal import ROUND_HALF_UP, Decimal
 from functools import reduce
+from hashlib import md5
+from json import dumps
 from operator import iand, ior
 
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db import connection, models
-from django.db.models import CharField, F, Q
+from django.db import connections, models, transaction
+from django.db.models import CharField, F, Q, Subquery
 from django.db.models.base import ModelBase
-from django.db.models.signals import m2m_changed
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 from django.urls import reverse
 from django.utils.encoding import force_str
@@ -17,7 +21,6 @@ from django.utils.translation import gettext_lazy as _
 from django.utils.translation import pgettext_lazy as __
 from mezzanine.conf import settings
 from mezzanine.core.fields import FileField
-from mezzanine.core.managers import DisplayableManager
 from mezzanine.core.models import (
     ContentTyped,
     Displayable,
@@ -30,7 +33,13 @@ from mezzanine.pages.models import Page
 from mezzanine.utils.models import AdminThumbMixin, upload_to
 
 from cartridge.shop import fields, managers
-from cartridge.shop.utils import clear_session
+from cartridge.shop.utils import (
+    bump_catalogue_version,
+    bump_discount_version,
+    catalogue_version,
+    clear_session,
+    discount_version,
+)
 
 
 class Priced(models.Model):
@@ -52,8 +61,13 @@ class Priced(models.Model):
 
     def on_sale(self):
         """
-        Returns True if the sale price is applicable.
+        Returns True if the sale price is applicable. If the instance
+        was queried with ``with_effective_price``, the lowest of its
+        own sale price and those given by the current sales is used.
         """
+        if hasattr(self, "effective_price") and self.unit_price is not None:
+            price = self._effective_price()
+            return price is not None and price < self.unit_price
         n = now()
         valid_from = self.sale_from is None or self.sale_from < n
         valid_to = self.sale_to is None or self.sale_to > n
@@ -71,11 +85,26 @@ class Priced(models.Model):
         the unit price.
         """
         if self.on_sale():
+            if hasattr(self, "effective_price"):
+                return self._effective_price()
             return self.sale_price
         elif self.has_price():
             return self.unit_price
         return Decimal("0")
 
+    def _effective_price(self):
+        """
+        Returns the ``effective_price`` annotation rounded to the
+        decimal places of the price fields, as stored sale prices are,
+        since percentage sales resolve to more decimal places when
+        querying.
+        """
+        if self.effective_price is None:
+            return None
+        places = self._meta.get_field("unit_price").decimal_places
+        exponent = Decimal(1).scaleb(-places)
+        return Decimal(self.effective_price).quantize(exponent, ROUND_HALF_UP)
+
     def copy_price_fields_to(self, obj_to):
         """
         Copies each of the fields for the ``Priced`` model from one
@@ -90,12 +119,12 @@ class Priced(models.Model):
 
 class BaseProduct(Displayable):
     """
-    Exists solely to store ``DisplayableManager`` as the main manager.
+    Exists solely to store ``ProductManager`` as the main manager.
     If it's defined on ``Product``, a concrete model, then each
     ``Product`` subclass loses the custom manager.
     """
 
-    objects = DisplayableManager()
+    objects = managers.ProductManager()
 
     class Meta:
         abstract = True
@@ -146,6 +175,55 @@ class Product(BaseProduct, Priced, RichText, ContentTyped, AdminThumbMixin):
     def get_absolute_url(self):
         return reverse("shop_product", kwargs={"slug": self.slug})
 
+    def page_payload(self):
+        """
+        Returns a dict of the data for the product's page that's derived
+        from its variations, images and related products, shared by the
+        ``product`` view and ``AddProductForm``. This is cached against
+        the catalogue version for ``SHOP_PRODUCT_CACHE_SECONDS``, and on
+        the product for the rest of the request.
+        """
+        if not hasattr(self, "_page_payload"):
+            seconds = settings.SHOP_PRODUCT_CACHE_SECONDS
+            cache_key = "cartridge-product-%s-%s" % (catalogue_version(), self.id)
+            payload = cache.get(cache_key) if seconds else None
+            if payload is None:
+                payload = self._build_page_payload()
+                if seconds:
+                    cache.set(cache_key, payload, seconds)
+            self._page_payload = payload
+        return self._page_payload
+
+    def _build_page_payload(self):
+        """
+        Builds the data returned by ``page_payload``. Stock levels
+        aren't included, since they're validated when adding to the
+        cart rather than displayed.
+        """
+        fields = [f.name for f in ProductVariation.option_fields()]
+        variations = list(self.variations.with_effective_price())
+        variations_json = dumps(
+            [
+                {f: getattr(v, f) for f in fields + ["sku", "image_id"]}
+                for v in variations
+            ]
+        )
+        # Choices for the options of variations that have a price.
+        option_choices = {}
+        for name in fields:
+            values = [getattr(v, name) for v in variations if v.unit_price is not None]
+            option_choices[name] = [value for value in dict.fromkeys(values) if value]
+        related_ids = []
+        if settings.SHOP_USE_RELATED_PRODUCTS:
+            related_ids = list(self.related_products.values_list("id", flat=True))
+        return {
+            "variations": variations,
+            "variations_json": variations_json,
+            "option_choices": option_choices,
+            "images": list(self.images.all()),
+            "related_ids": related_ids,
+        }
+
     def copy_default_variation(self):
         """
         Copies the price and image fields from the default variation
@@ -236,6 +314,7 @@ class ProductVariation(Priced, metaclass=ProductVariationMetaclass):
         "Product", related_name="variations", on_delete=models.CASCADE
     )
     default = models.BooleanField(_("Default"), default=False)
+    num_in_carts = models.IntegerField(_("Number in carts"), default=0, editable=False)
     image = models.ForeignKey(
         "ProductImage",
         verbose_name=_("Image"),
@@ -314,21 +393,13 @@ class ProductVariation(Priced, metaclass=ProductVariationMetaclass):
     def live_num_in_stock(self):
         """
         Returns the live number in stock, which is
-        ``self.num_in_stock - num in carts``. Also caches the value
-        for subsequent lookups.
+        ``self.num_in_stock - self.num_in_carts``. ``num_in_carts`` is
+        maintained as cart items are saved and deleted, and is released
+        for expired carts when they're purged.
         """
         if self.num_in_stock is None:
             return None
-        if not hasattr(self, "_cached_num_in_stock"):
-            num_in_stock = self.num_in_stock
-            carts = Cart.objects.current()
-            items = CartItem.objects.filter(sku=self.sku, cart__in=carts)
-            aggregate = items.aggregate(quantity_sum=models.Sum("quantity"))
-            num_in_carts = aggregate["quantity_sum"]
-            if num_in_carts is not None:
-                num_in_stock = num_in_stock - num_in_carts
-            self._cached_num_in_stock = num_in_stock
-        return self._cached_num_in_stock
+        return self.num_in_stock - self.num_in_carts
 
     def has_stock(self, quantity=1):
         """
@@ -447,6 +518,74 @@ class Category(Page, RichText):
         return products
 
 
+class CategoryProduct(models.Model):
+    """
+    Products in a category, either explicitly assigned or matching
+    the category's filters. Stored when ``SHOP_CATEGORY_PRODUCT_INDEX``
+    is True so that listing a category's products is a single join
+    rather than evaluating ``Category.filters`` each time.
+    """
+
+    category = models.ForeignKey(
+        "Category", related_name="category_products", on_delete=models.CASCADE
+    )
+    product = models.ForeignKey(
+        "Product", related_name="category_products", on_delete=models.CASCADE
+    )
+
+    objects = managers.CategoryProductManager()
+
+    class Meta:
+        unique_together = ("category", "product")
+
+
+@receiver(post_save, sender=Category)
+def category_update_products(sender, instance, *args, **kwargs):
+    """
+    Update the stored products for a category when it's saved, since
+    its filters may have changed.
+    """
+    CategoryProduct.objects.update_for_categories([instance])
+
+
+@receiver(m2m_changed, sender=Category.options.through)
+@receiver(m2m_changed, sender=Product.categories.through)
+def category_products_changed(sender, instance, action, *args, **kwargs):
+    """
+    Update the stored products for categories when products are
+    assigned to them, or their option filters change.
+    """
+    if action in ("post_add", "post_remove", "post_clear"):
+        if isinstance(instance, Category):
+            CategoryProduct.objects.update_for_categories([instance])
+        else:
+            CategoryProduct.objects.update_for_products([instance.id])
+
+
+@receiver(post_save, sender=Product)
+def product_update_categories(sender, instance, *args, **kwargs):
+    """
+    Update the stored products for categories when a product is
+    saved, which occurs after its variations are saved in the admin.
+    """
+    CategoryProduct.objects.update_for_products([instance.id])
+
+
+@receiver(post_save, sender=ProductVariation)
+@receiver(post_delete, sender=ProductVariation)
+def variation_update_categories(sender, instance, *args, **kwargs):
+    """
+    Update the stored products for categories when a variation is
+    saved or deleted outside of the admin, since categories filter
+    products by their variations' options and prices. Deferred until
+    the transaction is committed, as variations are also deleted
+    along with their product.
+    """
+    product_id = instance.product_id
+    update = CategoryProduct.objects.update_for_products
+    transaction.on_commit(lambda: update([product_id]))
+
+
 class Order(SiteRelated):
 
     billing_detail_first_name = CharField(_("First name"), max_length=100)
@@ -534,11 +673,15 @@ class Order(SiteRelated):
             self.total -= Decimal(self.discount_total)
         if self.tax_total is not None and not settings.SHOP_TAX_INCLUDED:
             self.total += Decimal(self.tax_total)
-        self.save()  # We need an ID before we can add related items.
-        for item in request.cart:
-            product_fields = [f.name for f in SelectedProduct._meta.fields]
-            item = {f: getattr(item, f) for f in product_fields}
-            self.items.create(**item)
+        with transaction.atomic():
+            self.save()  # We need an ID before we can add related items.
+            items = []
+            for item in request.cart:
+                item = {f: getattr(item, f) for f in SELECTED_PRODUCT_FIELDS}
+                item = OrderItem(order=self, **item)
+                item.total_price = item.unit_price * item.quantity
+                items.append(item)
+            OrderItem.objects.bulk_create(items)
 
     def complete(self, request):
         """
@@ -549,22 +692,85 @@ class Order(SiteRelated):
         """
         self.save()  # Save the transaction ID.
         discount_code = request.session.get("discount_code")
-        clear_session(request, "order", *self.session_fields)
+        clear_session(
+            request,
+            "order",
+            "checkout_handlers",
+            "discount_inputs",
+            *self.session_fields,
+        )
+        if not getattr(self, "_stock_removed", False):
+            self.remove_stock(request)
+        variations = ProductVariation.objects.filter(sku__in=request.cart.skus())
+        variations = {v.sku: v for v in variations.select_related("product")}
         for item in request.cart:
             try:
-                variation = ProductVariation.objects.get(sku=item.sku)
-            except ProductVariation.DoesNotExist:
+                variation = variations[item.sku]
+            except KeyError:
                 pass
             else:
-                variation.update_stock(item.quantity * -1)
                 variation.product.actions.purchased()
-        if discount_code:
-            DiscountCode.objects.active().filter(code=discount_code).update(
-                uses_remaining=models.F("uses_remaining") - 1
-            )
+        if discount_code and not getattr(self, "_discount_reserved", False):
+            DiscountCode.objects.reserve(discount_code)
         request.cart.delete()
         del request.session["cart"]
 
+    def _stock_quantities(self, request, sign):
+        """
+        Returns a dict of SKUs mapped to quantities for the cart's
+        items, used for updating stock levels.
+        """
+        quantities = {}
+        for item in request.cart:
+            quantity = quantities.get(item.sku, 0) + sign * item.quantity
+            quantities[item.sku] = quantity
+        return quantities
+
+    def remove_stock(self, request, allow_negative=True):
+        """
+        Reduce the stock level for the cart's items with a single
+        update. If ``allow_negative`` is False and any item's stock
+        would go below zero, stock is left unchanged and False is
+        returned. Called before payment when
+        ``SHOP_ORDER_ALLOW_NEGATIVE_STOCK`` is False, otherwise by
+        ``complete``.
+        """
+        quantities = self._stock_quantities(request, -1)
+        removed = ProductVariation.objects.update_stock(quantities, allow_negative)
+        self._stock_removed = removed
+        return removed
+
+    def return_stock(self, request):
+        """
+        Return stock removed by ``remove_stock``, when payment fails
+        in ``checkout.place_order``.
+        """
+        if getattr(self, "_stock_removed", False):
+            ProductVariation.objects.update_stock(self._stock_quantities(request, 1))
+            self._stock_removed = False
+
+    def reserve_discount(self):
+        """
+        Use up one of the remaining uses of the order's discount code,
+        returning False if none remain. Called before payment so that
+        concurrent orders can't use the code more times than allowed.
+        """
+        if not self.discount_code:
+            return True
+        reserved = DiscountCode.objects.reserve(self.discount_code)
+        self._discount_reserved = reserved
+        return reserved
+
+    def release_discount(self):
+        """
+        Release the use of the discount code reserved by
+        ``reserve_discount``, when payment fails in
+        ``checkout.place_order``.
+        """
+        if getattr(self, "_discount_reserved", False):
+            DiscountCode.objects.release(self.discount_code)
+            self._discount_reserved = False
+
     def details_as_dict(self):
         """
         Returns the billing_detail_* and shipping_detail_* fields
@@ -601,6 +807,14 @@ class Cart(models.Model):
 
     objects = managers.CartManager()
 
+    def delete(self, *args, **kwargs):
+        """
+        Release the stock held by the cart's items when deleting it.
+        """
+        with transaction.atomic():
+            Cart.objects.release_stock([self.id])
+            return super().delete(*args, **kwargs)
+
     def __iter__(self):
         """
         Allow the cart to be iterated giving access to the cart's items,
@@ -652,10 +866,19 @@ class Cart(models.Model):
     def skus(self):
         """
         Returns a list of skus for items in the cart. Used by
-        ``upsell_products`` and ``calculate_discount``.
+        ``upsell_products``.
         """
         return [item.sku for item in self]
 
+    def fingerprint(self):
+        """
+        Returns a hash of the SKU, quantity and unit price of each of
+        the cart's items, which changes whenever the cart's contents
+        or prices do.
+        """
+        items = sorted((i.sku, i.quantity, str(i.unit_price)) for i in self)
+        return md5(repr(items).encode("utf-8")).hexdigest()
+
     def upsell_products(self):
         """
         Returns the upsell products for each of the items in the cart.
@@ -673,20 +896,27 @@ class Cart(models.Model):
         Calculates the discount based on the items in a cart, some
         might have the discount, others might not.
         """
-        # Discount applies to cart total if not product specific.
-        products = discount.all_products()
-        if products.count() == 0:
-            return discount.calculate(self.total_price())
-        total = Decimal("0")
-        # Create a list of skus in the cart that are applicable to
-        # the discount, and total the discount for applicable items.
-        lookup = {"product__in": products, "sku__in": self.skus()}
-        discount_variations = ProductVariation.objects.filter(**lookup)
-        discount_skus = discount_variations.values_list("sku", flat=True)
+        return self.discount_breakdown(discount)["total"]
+
+    def discount_breakdown(self, discount):
+        """
+        Returns a dict with the ``total`` discount for the cart, and
+        ``items`` mapping the SKU of each item the discount applies to
+        with the discount for the item. The cart's items and the SKUs
+        the discount applies to are each only retrieved once, with the
+        discount for each item calculated in Python.
+        """
+        items = {}
+        discount_skus = discount.eligible_skus()
+        if discount_skus is None:
+            # Discount applies to cart total if not product specific.
+            total = discount.calculate(self.total_price())
+            return {"total": total, "items": items}
         for item in self:
             if item.sku in discount_skus:
-                total += discount.calculate(item.unit_price) * item.quantity
-        return total
+                amount = discount.calculate(item.unit_price) * item.quantity
+                items[item.sku] = items.get(item.sku, 0) + amount
+        return {"total": sum(items.values(), Decimal("0")), "items": items}
 
 
 class SelectedProduct(models.Model):
@@ -719,6 +949,10 @@ class SelectedProduct(models.Model):
             self.delete()
 
 
+# Names of the fields copied from cart items to order items.
+SELECTED_PRODUCT_FIELDS = [f.name for f in SelectedProduct._meta.fields]
+
+
 class CartItem(SelectedProduct):
 
     cart = models.ForeignKey("Cart", related_name="items", on_delete=models.CASCADE)
@@ -729,12 +963,45 @@ class CartItem(SelectedProduct):
         return self.url
 
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
+        """
+        Reserve the change in quantity against the variation's stock.
+        If the item has been deleted due to a zero quantity, this is
+        handled in ``delete``.
+        """
+        with transaction.atomic():
+            if self.id is None or self.quantity > 0:
+                self._reserve_stock(self.quantity)
+            super().save(*args, **kwargs)
 
         # Check if this is the last cart item being removed
         if self.quantity == 0 and not self.cart.items.exists():
             self.cart.delete()
 
+    def delete(self, *args, **kwargs):
+        """
+        Release the reserved quantity when the item is removed.
+        """
+        with transaction.atomic():
+            self._reserve_stock(0)
+            return super().delete(*args, **kwargs)
+
+    def _reserve_stock(self, quantity):
+        """
+        Adjust the number in carts for the item's variation to reserve
+        the given quantity in place of the item's stored quantity. The
+        stored quantity is read within the update, with the item's row
+        locked until the transaction completes, so that concurrent
+        changes to the same item are each reserved against the quantity
+        saved by the other.
+        """
+        stored = CartItem.objects.filter(id=self.id)
+        if self.id is not None:
+            list(stored.select_for_update().values_list("id"))
+        stored = Coalesce(Subquery(stored.values("quantity")), 0)
+        num_in_carts = F("num_in_carts") + quantity - stored
+        variations = ProductVariation.objects.filter(sku=self.sku)
+        variations.update(num_in_carts=num_in_carts)
+
 
 class OrderItem(SelectedProduct):
     """
@@ -744,6 +1011,28 @@ class OrderItem(SelectedProduct):
     order = models.ForeignKey("Order", related_name="items", on_delete=models.CASCADE)
 
 
+class OrderEmail(models.Model):
+    """
+    An order receipt email queued when ``SHOP_ORDER_EMAIL_QUEUE`` is
+    True, which is rendered and sent by the ``send_order_emails``
+    management command.
+    """
+
+    order = models.ForeignKey("Order", related_name="emails", on_delete=models.CASCADE)
+    time = models.DateTimeField(_("Time"), auto_now_add=True)
+    sent = models.DateTimeField(_("Sent"), blank=True, null=True)
+    attempts = models.IntegerField(_("Attempts"), default=0)
+    next_attempt = models.DateTimeField(_("Next attempt"), default=now)
+    error = models.TextField(_("Error"), blank=True)
+
+    objects = managers.OrderEmailManager()
+
+    class Meta:
+        verbose_name = _("Order email")
+        verbose_name_plural = _("Order emails")
+        indexes = [models.Index(fields=["sent", "next_attempt"])]
+
+
 class ProductAction(models.Model):
     """
     Records an incremental value for an action against a product such
@@ -805,6 +1094,31 @@ class Discount(models.Model):
         filters = reduce(ior, filters + [Q(id__in=self.products.only("id"))])
         return Product.objects.filter(filters).distinct()
 
+    def eligible_skus(self):
+        """
+        Return the set of SKUs for the variations of ``all_products``,
+        or None if the discount isn't limited to any products. Cached
+        against the catalogue and discount versions, so that checking a
+        cart against the discount doesn't evaluate each category's
+        filters.
+        """
+        cache_key = "cartridge-discount-skus-%s-%s-%s-%s" % (
+            catalogue_version(),
+            discount_version(),
+            self._meta.model_name,
+            self.pk,
+        )
+        cached = cache.get(cache_key)
+        if cached is None:
+            products = self.all_products()
+            skus = None
+            if products.exists():
+                variations = ProductVariation.objects.filter(product__in=products)
+                skus = set(variations.values_list("sku", flat=True))
+            cached = (skus,)
+            cache.set(cache_key, cached)
+        return cached[0]
+
 
 class Sale(Discount):
     """
@@ -813,13 +1127,55 @@ class Sale(Discount):
     selected categories and products for the sale.
     """
 
+    UPDATE_PENDING = "pending"
+    UPDATE_QUEUED = "queued"
+    UPDATE_RUNNING = "running"
+    UPDATE_CHANGED = "changed"
+    UPDATE_COMPLETE = "complete"
+    UPDATE_FAILED = "failed"
+    UPDATE_STATUS_CHOICES = (
+        (UPDATE_PENDING, _("Pending")),
+        (UPDATE_QUEUED, _("Queued")),
+        (UPDATE_RUNNING, _("Running")),
+        (UPDATE_CHANGED, _("Changed while running")),
+        (UPDATE_COMPLETE, _("Complete")),
+        (UPDATE_FAILED, _("Failed")),
+    )
+
+    update_status = CharField(
+        _("Update status"),
+        max_length=20,
+        choices=UPDATE_STATUS_CHOICES,
+        default=UPDATE_COMPLETE,
+        editable=False,
+    )
+    update_progress = models.IntegerField(
+        _("Products updated"), default=0, editable=False
+    )
+
+    objects = managers.SaleManager()
+
     class Meta:
         verbose_name = _("Sale")
         verbose_name_plural = _("Sales")
+        indexes = [models.Index(fields=["active", "valid_from", "valid_to"])]
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
+        Sale.objects.schedule_update(self.id)
+
+    def apply(self):
+        """
+        Apply the sale to its products, store the products it applies
+        to for ``with_effective_price``, and update the stored products
+        for categories that may be affected. The sale fields are still
+        written to products since category filters, and instances that
+        aren't annotated, read them.
+        """
         self.update_products()
+        SaleProduct.objects.update_for_sale(self)
+        CategoryProduct.objects.update_for_sale(self)
+        bump_catalogue_version()
 
     def update_products(self):
         """
@@ -855,34 +1211,52 @@ class Sale(Discount):
                     "sale_from": self.valid_from,
                 }
                 using = priced_objects.db
+                priced_objects = priced_objects.filter(**extra_filter)
                 if "mysql" not in settings.DATABASES[using]["ENGINE"]:
-                    priced_objects.filter(**extra_filter).update(**update)
-                else:
-                    # Work around for MySQL which does not allow update
-                    # to operate on subquery where the FROM clause would
-                    # have it operate on the same table, so we update
-                    # each instance individually: http://bit.ly/1xMOGpU
-                    #
-                    # Also MySQL may raise a 'Data truncated' warning here
-                    # when doing a calculation that exceeds the precision
-                    # of the price column. In this case it's safe to ignore
-                    # it and the calculation will still be applied, but
-                    # we need to massage transaction management in order
-                    # to continue successfully: http://bit.ly/1xMOJCd
-                    for priced in priced_objects.filter(**extra_filter):
-                        for field, value in list(update.items()):
-                            setattr(priced, field, value)
-                        try:
-                            priced.save()
-                        except Warning:
-                            connection.set_rollback(False)
+                    self._update_progress(priced_objects.update(**update))
+                    continue
+                # Work around for MySQL which does not allow update
+                # to operate on subquery where the FROM clause would
+                # have it operate on the same table, so we retrieve the
+                # IDs first and update them in batches:
+                # http://bit.ly/1xMOGpU
+                #
+                # Also MySQL may raise a 'Data truncated' warning here
+                # when doing a calculation that exceeds the precision
+                # of the price column. In this case it's safe to ignore
+                # it and the calculation will still be applied, but
+                # we need to massage transaction management in order
+                # to continue successfully: http://bit.ly/1xMOJCd
+                ids = list(priced_objects.values_list("id", flat=True))
+                batch_size = settings.SHOP_SALE_UPDATE_BATCH_SIZE
+                manager = priced_objects.model._base_manager.using(using)
+                for i in range(0, len(ids), batch_size):
+                    batch = manager.filter(id__in=ids[i : i + batch_size])
+                    try:
+                        batch.update(**update)
+                    except Warning:
+                        connections[using].set_rollback(False)
+                    self._update_progress(len(ids[i : i + batch_size]))
+
+    def _update_progress(self, count):
+        """
+        Add to the number of products and variations updated while
+        applying the sale.
+        """
+        progress = F("update_progress") + count
+        Sale.objects.filter(id=self.id).update(update_progress=progress)
 
     def delete(self, *args, **kwargs):
         """
-        Clear this sale from products when deleting the sale.
+        Clear this sale from products when deleting the sale, and
+        update the stored products for categories that were affected.
         """
+        categories = CategoryProduct.objects.categories_for_sale(self)
+        category_ids = list(categories.values_list("id", flat=True))
         self._clear()
         super().delete(*args, **kwargs)
+        categories = Category.objects.filter(id__in=category_ids)
+        CategoryProduct.objects.update_for_categories(categories)
 
     def _clear(self):
         """
@@ -899,14 +1273,70 @@ class Sale(Discount):
             priced_model.objects.filter(sale_id=self.id).update(**update)
 
 
+class SaleProduct(models.Model):
+    """
+    Products a sale applies to, including products in the sale's
+    categories, used for resolving sale prices when querying products
+    via ``with_effective_price``.
+    """
+
+    sale = models.ForeignKey(
+        "Sale", related_name="sale_products", on_delete=models.CASCADE
+    )
+    product = models.ForeignKey(
+        "Product", related_name="sale_products", on_delete=models.CASCADE
+    )
+
+    objects = managers.SaleProductManager()
+
+    class Meta:
+        unique_together = ("product", "sale")
+
+
 @receiver(m2m_changed, sender=Sale.products.through)
-def sale_update_products(sender, instance, action, *args, **kwargs):
+@receiver(m2m_changed, sender=Sale.categories.through)
+def sale_update_products(sender, instance, action, pk_set, *args, **kwargs):
     """
     Signal for updating products for the sale - needed since the
-    products won't be assigned to the sale when it is first saved.
+    products and categories won't be assigned to the sale when it is
+    first saved.
+    """
+    if action in ("post_add", "post_remove", "post_clear"):
+        if isinstance(instance, Sale):
+            Sale.objects.schedule_update(instance.id)
+        else:
+            for sale_id in pk_set or ():
+                Sale.objects.schedule_update(sale_id)
+    elif action == "pre_clear" and not isinstance(instance, Sale):
+        # Clearing sales from a product or category doesn't provide the
+        # sales, so look them up before they're removed. The clear runs
+        # in a transaction, so the sales are applied once it's done.
+        field = instance._meta.model_name
+        rows = sender.objects.filter(**{field: instance})
+        for sale_id in rows.values_list("sale_id", flat=True):
+            Sale.objects.schedule_update(sale_id)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=ProductVariation)
+@receiver(post_delete, sender=ProductVariation)
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Sale)
+@receiver(post_delete, sender=Sale)
+@receiver(m2m_changed, sender=Category.options.through)
+@receiver(m2m_changed, sender=Product.categories.through)
+@receiver(m2m_changed, sender=Product.related_products.through)
+@receiver(m2m_changed, sender=Sale.products.through)
+def catalogue_changed(sender, *args, **kwargs):
     """
-    if action == "post_add":
-        instance.update_products()
+    Invalidate cached catalogue data such as category and product
+    pages when products, categories or sales change.
+    """
+    bump_catalogue_version()
 
 
 class DiscountCode(Discount):
@@ -931,6 +1361,17 @@ class DiscountCode(Discount):
 
     objects = managers.DiscountCodeManager()
 
+    def is_active(self):
+        """
+        Returns True if the code is flagged as active, within its date
+        range, and has uses remaining, the same as
+        ``DiscountCodeManager.active``.
+        """
+        n = now()
+        valid_from = self.valid_from is None or self.valid_from <= n
+        valid_to = self.valid_to is None or self.valid_to >= n
+        return self.active and valid_from and valid_to and self.uses_remaining != 0
+
     def calculate(self, amount):
         """
         Calculates the discount for the given amount.
@@ -947,3 +1388,15 @@ class DiscountCode(Discount):
     class Meta:
         verbose_name = _("Discount code")
         verbose_name_plural = _("Discount codes")
+
+
+@receiver(post_save, sender=DiscountCode)
+@receiver(post_delete, sender=DiscountCode)
+@receiver(m2m_changed, sender=DiscountCode.products.through)
+@receiver(m2m_changed, sender=DiscountCode.categories.through)
+def discount_code_changed(sender, *args, **kwargs):
+    """
+    Invalidate the cached discount codes and their SKUs when discount
+    codes, or their products or categories change.
+    """
+    bump_discount_version()
@@ -1,9 +1,14 @@
+from hashlib import md5
+
+from django.core.cache import cache
+from django.core.paginator import Page, Paginator
 from django.template.defaultfilters import slugify
 from mezzanine.conf import settings
 from mezzanine.pages.page_processors import processor_for
 from mezzanine.utils.views import paginate
 
 from cartridge.shop.models import Category, Product
+from cartridge.shop.utils import catalogue_version, keyset_paginate
 
 
 @processor_for(Category, exact_page=True)
@@ -12,24 +17,73 @@ def category_processor(request, page):
     Add paging/sorting to the products for the category.
     """
     settings.clear_cache()
-    products = (
-        Product.objects.published(for_user=request.user)
-        .filter(page.category.filters())
-        .distinct()
-    )
+    products = Product.objects.published(for_user=request.user)
+    if settings.SHOP_CATEGORY_PRODUCT_INDEX:
+        products = products.filter(category_products__category=page.category)
+    else:
+        products = products.filter(page.category.filters()).distinct()
+    products = products.with_stock().with_effective_price()
     sort_options = [
         (slugify(option[0]), option[1]) for option in settings.SHOP_PRODUCT_SORT_OPTIONS
     ]
     sort_by = request.GET.get(
         "sort", sort_options[0][1] if sort_options else "-date_added"
     )
-    products = paginate(
-        products.order_by(sort_by),
-        request.GET.get("page", 1),
-        settings.SHOP_PER_PAGE_CATEGORY,
-        settings.MAX_PAGING_LINKS,
-    )
+    page_num = request.GET.get("page", 1)
+    cache_key = cached = None
+    use_cache = not settings.SHOP_KEYSET_PAGINATION and settings.SHOP_PER_PAGE_CATEGORY
+    if use_cache and settings.SHOP_CATEGORY_CACHE_SECONDS:
+        # The sort and page are hashed rather than slugified, since
+        # slugify would strip the "-" for descending sorts.
+        sort_and_page = md5(f"{sort_by}:{page_num}".encode("utf-8")).hexdigest()
+        cache_key = "cartridge-category-%s-%s-%s-%s" % (
+            catalogue_version(),
+            page.category.id,
+            sort_and_page,
+            request.user.is_staff,
+        )
+        cached = cache.get(cache_key)
+    if settings.SHOP_KEYSET_PAGINATION:
+        products = keyset_paginate(
+            request, products, sort_by, settings.SHOP_PER_PAGE_CATEGORY
+        )
+    elif cached is not None:
+        products = cached_page(request, cached)
+    else:
+        products = paginate(
+            products.order_by(sort_by),
+            page_num,
+            settings.SHOP_PER_PAGE_CATEGORY,
+            settings.MAX_PAGING_LINKS,
+        )
+        if cache_key:
+            cached = {
+                "ids": [p.id for p in products],
+                "number": products.number,
+                "count": products.paginator.count,
+                "visible_page_range": list(products.visible_page_range),
+            }
+            cache.set(cache_key, cached, settings.SHOP_CATEGORY_CACHE_SECONDS)
     products.sort_by = sort_by
     sub_categories = page.category.children.published()
     child_categories = Category.objects.filter(id__in=sub_categories)
     return {"products": products, "child_categories": child_categories}
+
+
+def cached_page(request, cached):
+    """
+    Rebuild a page of products from the product IDs and paging data
+    cached by ``category_processor``, loading only the products on the
+    page by ID so that stock levels remain current, and products that
+    are no longer published are left out.
+    """
+    products = Product.objects.published(for_user=request.user)
+    products = products.filter(id__in=cached["ids"])
+    products = products.with_stock().with_effective_price()
+    in_bulk = products.in_bulk()
+    object_list = [in_bulk[id] for id in cached["ids"] if id in in_bulk]
+    paginator = Paginator(object_list, settings.SHOP_PER_PAGE_CATEGORY)
+    paginator.count = cached["count"]
+    page = Page(object_list, cached["number"], paginator)
+    page.visible_page_range = cached["visible_page_range"]
+    return page
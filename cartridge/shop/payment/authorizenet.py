@@ -1,11 +1,9 @@
-from urllib.error import URLError
-from urllib.request import Request, urlopen
-
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.http import urlencode
 from mezzanine.conf import settings
 
 from cartridge.shop.checkout import CheckoutError
+from cartridge.shop.payment import transport
 
 AUTH_NET_LIVE = "https://secure.authorize.net/gateway/transact.dll"
 AUTH_NET_TEST = "https://test.authorize.net/gateway/transact.dll"
@@ -89,8 +87,8 @@ def process(request, order_form, order):
         "data": trans["postString"].encode("utf-8"),
     }
     try:
-        all_results = urlopen(Request(**request_args)).read()
-    except URLError:
+        all_results = transport.post(**request_args)
+    except transport.TransportError:
         raise CheckoutError("Could not talk to authorize.net payment gateway")
 
     parsed_results = all_results.decode("utf-8").split(
@@ -1,12 +1,10 @@
-from urllib.parse import urlencode
-from urllib.request import urlopen
-
 from django.core.exceptions import ImproperlyConfigured
 from django.http import QueryDict
 from django.utils.translation import gettext as _
 from mezzanine.conf import settings
 
 from cartridge.shop.checkout import CheckoutError
+from cartridge.shop.payment import transport
 
 GATEWAY_COMMAND = getattr(settings, "EGATE_GATEWAY_COMMAND", "pay")
 GATEWAY_VERSION = getattr(settings, "EGATE_GATEWAY_VERSION", "1")
@@ -51,9 +49,9 @@ def process(request, order_form, order):
     # raised, or the error code doesn't indicate success (0) then raise
     # a CheckoutError.
     try:
-        response = QueryDict(urlopen(GATEWAY_URL, urlencode(post_data)).read())
+        response = QueryDict(transport.post(GATEWAY_URL, post_data))
     except Exception as e:
-        raise CheckoutError(_("A general error occured: ") + e)
+        raise CheckoutError(_("A general error occured: ") + str(e))
     else:
         if response["vpc_TxnResponseCode"] != "0":
             raise CheckoutError(_("Transaction declined: ") + response["vpc_Message"])
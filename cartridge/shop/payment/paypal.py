@@ -1,6 +1,4 @@
 import locale
-from urllib.error import URLError
-from urllib.request import Request, urlopen
 
 from django.core.exceptions import ImproperlyConfigured
 from django.http import QueryDict
@@ -8,6 +6,7 @@ from django.utils.http import urlencode
 from mezzanine.conf import settings
 
 from cartridge.shop.checkout import CheckoutError
+from cartridge.shop.payment import transport
 
 PAYPAL_NVP_API_ENDPOINT_SANDBOX = "https://api-3t.sandbox.paypal.com/nvp"
 PAYPAL_NVP_API_ENDPOINT = "https://api-3t.paypal.com/nvp"
@@ -118,8 +117,8 @@ def process(request, order_form, order):
     # useful for debugging transactions
     # print trans['postString']
     try:
-        all_results = urlopen(Request(**request_args)).read()
-    except URLError:
+        all_results = transport.post(**request_args)
+    except transport.TransportError:
         raise CheckoutError("Could not talk to PayPal payment gateway")
     parsed_results = QueryDict(all_results)
     state = parsed_results["ACK"]
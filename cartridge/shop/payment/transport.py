@@ -0,0 +1,184 @@
+"""
+HTTP transport shared by the payment gateway handlers. Connections to
+each gateway host are kept open and reused across requests, requests
+are made with the timeouts defined by ``SHOP_PAYMENT_CONNECT_TIMEOUT``
+and ``SHOP_PAYMENT_READ_TIMEOUT``, and the duration of each request is
+logged and sent via the ``gateway_request`` signal.
+"""
+import logging
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from select import select
+from threading import Lock
+from time import monotonic
+from urllib.parse import urlencode, urlsplit
+
+from django.dispatch import Signal
+from mezzanine.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Sent after each request to a payment gateway with the ``host``,
+# ``method``, response ``status`` (None if no response was received),
+# number of ``attempts`` made, and ``duration`` in seconds.
+gateway_request = Signal()
+
+# Methods that can be safely retried after the request has been sent.
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+
+class TransportError(Exception):
+    """
+    Raised when a request to a payment gateway fails, or the gateway
+    responds with an HTTP error status.
+    """
+
+    pass
+
+
+class ConnectionPool:
+    """
+    Idle connections to a single host, which are reused for subsequent
+    requests to the host. Up to ``SHOP_PAYMENT_POOL_SIZE`` idle
+    connections are kept open.
+    """
+
+    def __init__(self, scheme, host, port):
+        self.connection_class = HTTPConnection
+        if scheme == "https":
+            self.connection_class = HTTPSConnection
+        self.host = host
+        self.port = port
+        self.idle = []
+        self.lock = Lock()
+
+    def get(self):
+        """
+        Returns an idle connection if there is one that the host
+        hasn't closed, otherwise a new connection.
+        """
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                connection = self.idle.pop()
+            if not is_dropped(connection):
+                return connection
+            connection.close()
+        timeout = settings.SHOP_PAYMENT_CONNECT_TIMEOUT
+        return self.connection_class(self.host, self.port, timeout=timeout)
+
+    def put(self, connection):
+        """
+        Return a connection to the pool once its response has been
+        read, closing it if the pool is full.
+        """
+        with self.lock:
+            if len(self.idle) < settings.SHOP_PAYMENT_POOL_SIZE:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+
+_pools = {}
+_pools_lock = Lock()
+
+
+def is_dropped(connection):
+    """
+    Returns True if an idle connection has been closed by the host,
+    which makes its socket readable.
+    """
+    try:
+        return bool(select([connection.sock], [], [], 0)[0])
+    except (OSError, ValueError):
+        return True
+
+
+def get_pool(scheme, host, port):
+    """
+    Returns the connection pool for the given host, creating it if
+    it doesn't exist.
+    """
+    key = (scheme, host, port)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(scheme, host, port)
+        return _pools[key]
+
+
+def request(method, url, data=None, headers=None):
+    """
+    Make a request to a payment gateway and return the response body.
+    Failures connecting or sending the request are retried up to
+    ``SHOP_PAYMENT_MAX_RETRIES`` times, as are failures reading the
+    response for idempotent methods. Other requests such as payments
+    aren't retried once sent, since the gateway may have processed
+    them. Raises ``TransportError`` if the request fails.
+    """
+    parts = urlsplit(url)
+    pool = get_pool(parts.scheme, parts.hostname, parts.port)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    status = None
+    attempts = 0
+    start = monotonic()
+    try:
+        while True:
+            attempts += 1
+            connection = pool.get()
+            sent = False
+            try:
+                if connection.sock is None:
+                    connection.connect()
+                    connection.sock.settimeout(settings.SHOP_PAYMENT_READ_TIMEOUT)
+                connection.request(method, path, body=data, headers=headers or {})
+                sent = True
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, HTTPException) as e:
+                connection.close()
+                retry = not sent or method in IDEMPOTENT_METHODS
+                if retry and attempts <= settings.SHOP_PAYMENT_MAX_RETRIES:
+                    continue
+                raise TransportError(f"Request to {parts.hostname} failed: {e}")
+            status = response.status
+            if response.will_close:
+                connection.close()
+            else:
+                pool.put(connection)
+            if status >= 400:
+                raise TransportError(f"{parts.hostname} responded with {status}")
+            return body
+    finally:
+        duration = monotonic() - start
+        logger.info(
+            "%s %s returned %s in %.3fs after %s attempt(s)",
+            method,
+            url,
+            status,
+            duration,
+            attempts,
+        )
+        gateway_request.send(
+            sender=None,
+            host=parts.hostname,
+            method=method,
+            status=status,
+            attempts=attempts,
+            duration=duration,
+        )
+
+
+def post(url, data, headers=None):
+    """
+    Post the given form data, either a dict or an encoded string, to
+    a payment gateway and return the response body.
+    """
+    if isinstance(data, dict):
+        data = urlencode(data)
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    headers = dict(headers or {})
+    headers.setdefault("Content-Type", "application/x-www-form-urlencoded")
+    return request("POST", url, data=data, headers=headers)
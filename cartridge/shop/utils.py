@@ -4,7 +4,11 @@ from locale import LC_MONETARY
 from locale import Error as LocaleError
 from locale import setlocale
 
+from django.core import signing
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.db.models import F, Q
+from django.utils.timezone import now
 from django.utils.translation import gettext as _
 from mezzanine.conf import settings
 from mezzanine.utils.importing import import_dotted_path
@@ -29,37 +33,106 @@ def clear_session(request, *names):
             pass
 
 
+def schedule_cart_purge():
+    """
+    Calls the handler defined by ``SHOP_HANDLER_CART_PURGE`` if one is
+    configured, at most once every ``SHOP_CART_PURGE_INTERVAL``
+    seconds. The handler should schedule expired carts to be purged
+    via ``Cart.objects.purge_expired`` outside of the request, for
+    example by queueing a background task.
+    """
+    if settings.SHOP_HANDLER_CART_PURGE:
+        interval = settings.SHOP_CART_PURGE_INTERVAL
+        if cache.add("cartridge-cart-purge", True, interval):
+            import_dotted_path(settings.SHOP_HANDLER_CART_PURGE)()
+
+
+def catalogue_version():
+    """
+    Returns the current catalogue version, used in cache keys for
+    data derived from products, categories and sales, so that it can
+    all be invalidated at once via ``bump_catalogue_version``.
+    """
+    return cache.get_or_set("cartridge-catalogue-version", 1, None)
+
+
+def bump_catalogue_version():
+    """
+    Increments the catalogue version, invalidating cached data keyed
+    with the previous version.
+    """
+    _bump_version("cartridge-catalogue-version")
+
+
+def discount_version():
+    """
+    Returns the current discount code version, used in cache keys for
+    data derived from discount codes. Kept separate from the catalogue
+    version so that changing discount codes, such as when their uses
+    are reserved at checkout, doesn't invalidate cached pages.
+    """
+    return cache.get_or_set("cartridge-discount-version", 1, None)
+
+
+def bump_discount_version():
+    """
+    Increments the discount code version, invalidating cached data
+    keyed with the previous version.
+    """
+    _bump_version("cartridge-discount-version")
+
+
+def _bump_version(cache_key):
+    try:
+        cache.incr(cache_key)
+    except ValueError:
+        cache.set(cache_key, 2, None)
+
+
 def recalculate_cart(request):
     """
     Updates an existing discount code, shipping, and tax when the
-    cart is modified.
+    cart is modified. Each of these is only recalculated when its
+    inputs have changed since it was last calculated: the cart's
+    fingerprint, and the discount code, catalogue and discount
+    versions for the discount, or the inputs given by ``checkout.handler_memo_key``
+    for shipping and tax.
     """
     from cartridge.shop import checkout
     from cartridge.shop.forms import DiscountForm
     from cartridge.shop.models import Cart
 
-    # Rebind the cart to request since it's been modified.
-    if request.session.get("cart") != request.cart.pk:
-        request.session["cart"] = request.cart.pk
-    request.cart = Cart.objects.from_request(request)
+    # Rebind the cart to the session since it may have just been
+    # created, and clear its cached items since they've been modified.
+    cart = request.cart
+    if request.session.get("cart") != cart.pk:
+        request.session["cart"] = cart.pk
+    cart.__dict__.pop("_cached_items", None)
+    if settings.SHOP_CART_SNAPSHOT:
+        # Only modified carts are touched when using snapshots.
+        cart.last_updated = now()
+        Cart.objects.filter(id=cart.id).update(last_updated=cart.last_updated)
 
     discount_code = request.session.get("discount_code", "")
     if discount_code:
-        # Clear out any previously defined discount code
-        # session vars.
-        names = ("free_shipping", "discount_code", "discount_total")
-        clear_session(request, *names)
-        discount_form = DiscountForm(request, {"discount_code": discount_code})
-        if discount_form.is_valid():
-            discount_form.set_discount()
+        versions = (catalogue_version(), discount_version())
+        inputs = [cart.fingerprint(), discount_code, *versions]
+        if request.session.get("discount_inputs") != inputs:
+            # Clear out any previously defined discount code
+            # session vars.
+            names = ("free_shipping", "discount_code", "discount_total")
+            clear_session(request, *names)
+            discount_form = DiscountForm(request, {"discount_code": discount_code})
+            if discount_form.is_valid():
+                discount_form.set_discount()
+                request.session["discount_inputs"] = inputs
 
     handler = lambda s: import_dotted_path(s) if s else lambda *args: None
     billship_handler = handler(settings.SHOP_HANDLER_BILLING_SHIPPING)
     tax_handler = handler(settings.SHOP_HANDLER_TAX)
     try:
         if request.session["order"]["step"] >= checkout.CHECKOUT_STEP_FIRST:
-            billship_handler(request, None)
-            tax_handler(request, None)
+            checkout.billship_and_tax(request, None, billship_handler, tax_handler)
     except (checkout.CheckoutError, ValueError, KeyError):
         pass
 
@@ -90,6 +163,97 @@ def sign(value):
     return hmac.new(key, value, digest).hexdigest()
 
 
+class KeysetPage:
+    """
+    A page of objects returned by ``keyset_paginate``, providing the
+    querystrings for linking to the next and previous pages.
+    """
+
+    keyset = True
+
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.next_querystring = ""
+        self.previous_querystring = ""
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+
+def keyset_paginate(request, objects, order_by, per_page, cursor_var="cursor"):
+    """
+    Return a ``KeysetPage`` for the given objects, ordered by the
+    ``order_by`` field and primary key. Rather than counting the
+    objects and using an offset, each page is retrieved by filtering
+    on the values of the first or last object of the adjacent page,
+    which are stored in a signed cursor in the querystring. Null
+    values for the field are ordered last.
+    """
+    descending = order_by.startswith("-")
+    field = order_by.lstrip("-")
+    try:
+        cursor = signing.loads(request.GET[cursor_var], salt=cursor_var)
+    except (KeyError, signing.BadSignature):
+        cursor = None
+    if cursor is None or cursor[0] != order_by:
+        cursor = (order_by, "next", None, None)
+    direction, value, pk = cursor[1:]
+
+    # Pages before the cursor are retrieved by reversing the ordering,
+    # and then the results.
+    forward = direction == "next"
+    nulls = {"nulls_last": True} if forward else {"nulls_first": True}
+    if descending == forward:
+        ordering, op = [F(field).desc(**nulls), "-pk"], "lt"
+    else:
+        ordering, op = [F(field).asc(**nulls), "pk"], "gt"
+    if pk is None:
+        where = Q()
+    elif value is None and forward:
+        where = Q(**{field + "__isnull": True, "pk__" + op: pk})
+    elif value is None:
+        where = Q(**{field + "__isnull": False})
+        where |= Q(**{field + "__isnull": True, "pk__" + op: pk})
+    else:
+        where = Q(**{field + "__" + op: value})
+        where |= Q(**{field: value, "pk__" + op: pk})
+        if forward:
+            where |= Q(**{field + "__isnull": True})
+
+    object_list = list(objects.filter(where).order_by(*ordering)[: per_page + 1])
+    has_more = len(object_list) > per_page
+    object_list = object_list[:per_page]
+    if forward:
+        page = KeysetPage(object_list, has_more, pk is not None)
+    else:
+        object_list.reverse()
+        page = KeysetPage(object_list, bool(object_list), has_more)
+
+    def querystring(obj, direction):
+        value = getattr(obj, field)
+        if value is not None:
+            value = str(value)
+        cursor = (order_by, direction, value, obj.pk)
+        querystring = request.GET.copy()
+        querystring.pop("page", None)
+        querystring[cursor_var] = signing.dumps(cursor, salt=cursor_var)
+        return querystring.urlencode()
+
+    if page.has_next:
+        page.next_querystring = querystring(object_list[-1], "next")
+    if page.has_previous:
+        page.previous_querystring = querystring(object_list[0], "previous")
+    return page
+
+
 def set_locale():
     """
     Sets the locale for currency formatting.
@@ -1,5 +1,4 @@
-from json import dumps
-
+from asgiref.sync import sync_to_async
 from django.contrib.auth.decorators import login_required
 from django.contrib.messages import info
 from django.db.models import Sum
@@ -9,6 +8,7 @@ from django.template.defaultfilters import slugify
 from django.template.loader import get_template
 from django.template.response import TemplateResponse
 from django.urls import reverse
+from django.utils.cache import add_never_cache_headers
 from django.utils.translation import gettext as _
 from django.views.decorators.cache import never_cache
 from mezzanine.conf import settings
@@ -24,7 +24,7 @@ from cartridge.shop.forms import (
     OrderForm,
 )
 from cartridge.shop.models import DiscountCode, Order, Product, ProductVariation
-from cartridge.shop.utils import recalculate_cart, sign
+from cartridge.shop.utils import keyset_paginate, recalculate_cart, sign
 
 try:
     from xhtml2pdf import pisa
@@ -53,12 +53,11 @@ def product(
     handling adding the product to either the cart or the wishlist.
     """
     published_products = Product.objects.published(for_user=request.user)
+    published_products = published_products.with_effective_price()
     product = get_object_or_404(published_products, slug=slug)
     fields = [f.name for f in ProductVariation.option_fields()]
-    variations = product.variations.all()
-    variations_json = dumps(
-        [{f: getattr(v, f) for f in fields + ["sku", "image_id"]} for v in variations]
-    )
+    payload = product.page_payload()
+    variations = payload["variations"]
     to_cart = request.method == "POST" and request.POST.get("add_wishlist") is None
     initial_data = {}
     if variations:
@@ -86,13 +85,13 @@ def product(
                 return response
     related = []
     if settings.SHOP_USE_RELATED_PRODUCTS:
-        related = product.related_products.published(for_user=request.user)
+        related = published_products.filter(id__in=payload["related_ids"])
     context = {
         "product": product,
         "editable_obj": product,
-        "images": product.images.all(),
+        "images": payload["images"],
         "variations": variations,
-        "variations_json": variations_json,
+        "variations_json": payload["variations_json"],
         "has_available_variations": any([v.has_price() for v in variations]),
         "related_products": related,
         "add_product_form": add_product_form,
@@ -214,7 +213,7 @@ def cart(
     context = {"cart_formset": cart_formset}
     context.update(extra_context or {})
     settings.clear_cache()
-    if settings.SHOP_DISCOUNT_FIELD_IN_CART and DiscountCode.objects.active().exists():
+    if settings.SHOP_DISCOUNT_FIELD_IN_CART and DiscountCode.objects.any_active():
         context["discount_form"] = discount_form
     return TemplateResponse(request, template, context)
 
@@ -224,6 +223,50 @@ def checkout_steps(request, form_class=OrderForm, extra_context=None):
     """
     Display the order form and handle processing of each step.
     """
+    state = checkout_form(request, form_class)
+    if isinstance(state, HttpResponse):
+        return state
+    if state["valid"]:
+        try:
+            checkout.billship_and_tax(
+                request, state["form"], billship_handler, tax_handler
+            )
+        except checkout.CheckoutError as e:
+            state["errors"].append(e)
+    return checkout_response(request, form_class, extra_context, state)
+
+
+async def async_checkout_steps(request, form_class=OrderForm, extra_context=None):
+    """
+    Async version of ``checkout_steps`` for use under ASGI, which awaits
+    the billing/shipping and tax handlers on the event loop, and runs
+    the remaining processing of each step in a thread. Requires Django
+    3.1 or later.
+    """
+    response = await sync_to_async(checkout_form)(request, form_class)
+    if not isinstance(response, HttpResponse):
+        state = response
+        if state["valid"]:
+            try:
+                await checkout.abillship_and_tax(
+                    request, state["form"], billship_handler, tax_handler
+                )
+            except checkout.CheckoutError as e:
+                state["errors"].append(e)
+        response = await sync_to_async(checkout_response)(
+            request, form_class, extra_context, state
+        )
+    add_never_cache_headers(response)
+    return response
+
+
+def checkout_form(request, form_class):
+    """
+    First part of processing a checkout step, before the billing/shipping
+    and tax handlers are called. Returns a redirect if an account is
+    required to checkout, otherwise a dict containing the current step,
+    its form, and whether the form was posted and valid.
+    """
 
     # Do the authentication check here rather than using standard
     # login_required decorator. This means we can check for a custom
@@ -240,8 +283,7 @@ def checkout_steps(request, form_class=OrderForm, extra_context=None):
         or checkout.CHECKOUT_STEP_FIRST
     )
     form = form_class(request, step, initial=initial)
-    data = request.POST
-    checkout_errors = []
+    valid = False
 
     if request.POST.get("back") is not None:
         # Back button in the form was pressed - load the order form
@@ -249,8 +291,9 @@ def checkout_steps(request, form_class=OrderForm, extra_context=None):
         step -= 1
         form = form_class(request, step, initial=initial)
     elif request.method == "POST" and request.cart.has_items():
-        form = form_class(request, step, initial=initial, data=data)
-        if form.is_valid():
+        form = form_class(request, step, initial=initial, data=request.POST)
+        valid = form.is_valid()
+        if valid:
             # Copy the current form fields to the session so that
             # they're maintained if the customer leaves the checkout
             # process, but remove sensitive fields from the session
@@ -273,64 +316,76 @@ def checkout_steps(request, form_class=OrderForm, extra_context=None):
             if step == checkout.CHECKOUT_STEP_FIRST:
                 form.set_discount()
 
-            # ALL STEPS - run billing/tax handlers. These are run on
-            # all steps, since all fields (such as address fields) are
-            # posted on each step, even as hidden inputs when not
-            # visible in the current step.
+    # ALL STEPS - when the form is valid, the billing/tax handlers are
+    # then run. These are run on all steps, since all fields (such as
+    # address fields) are posted on each step, even as hidden inputs
+    # when not visible in the current step.
+    return {
+        "step": step,
+        "form": form,
+        "initial": initial,
+        "valid": valid,
+        "errors": [],
+    }
+
+
+def checkout_response(request, form_class, extra_context, state):
+    """
+    Last part of processing a checkout step, after the billing/shipping
+    and tax handlers are called. Places the order on the final step,
+    otherwise moves to the next step if there were no errors, and
+    returns the response.
+    """
+    step = state["step"]
+    form = state["form"]
+    initial = state["initial"]
+    checkout_errors = state["errors"]
+
+    if state["valid"]:
+        # FINAL CHECKOUT STEP - run payment handler and process order.
+        if step == checkout.CHECKOUT_STEP_LAST and not checkout_errors:
+            # Create and save the initial order object so that
+            # the payment handler has access to all of the order
+            # fields, and try payment. If there is a payment error
+            # then the order is rolled back and its stock and discount
+            # code reservations are returned, otherwise the order
+            # is completed and the order receipt email is sent.
+            order = form.save(commit=False)
             try:
-                billship_handler(request, form)
-                tax_handler(request, form)
+                checkout.place_order(request, form, order, payment_handler)
             except checkout.CheckoutError as e:
+                # Error in payment handler.
                 checkout_errors.append(e)
-
-            # FINAL CHECKOUT STEP - run payment handler and process order.
-            if step == checkout.CHECKOUT_STEP_LAST and not checkout_errors:
-                # Create and save the initial order object so that
-                # the payment handler has access to all of the order
-                # fields. If there is a payment error then delete the
-                # order, otherwise remove the cart items from stock
-                # and send the order receipt email.
-                order = form.save(commit=False)
-                order.setup(request)
-                # Try payment.
-                try:
-                    transaction_id = payment_handler(request, form, order)
-                except checkout.CheckoutError as e:
-                    # Error in payment handler.
-                    order.delete()
-                    checkout_errors.append(e)
-                    if settings.SHOP_CHECKOUT_STEPS_CONFIRMATION:
-                        step -= 1
+                if settings.SHOP_CHECKOUT_STEPS_CONFIRMATION:
+                    step -= 1
+            else:
+                # Finalize order - ``order.complete()`` has performed
+                # final cleanup of session and cart.
+                # ``order_handler()`` can be defined by the
+                # developer to implement custom order processing.
+                # Then send the order email to the customer.
+                checkout.call_handler(order_handler, request, form, order)
+                checkout.send_order_email(request, order)
+                # Set the cookie for remembering address details
+                # if the "remember" checkbox was checked.
+                response = redirect("shop_complete")
+                if form.cleaned_data.get("remember"):
+                    remembered = f"{sign(order.key)}:{order.key}"
+                    set_cookie(
+                        response, "remember", remembered, secure=request.is_secure()
+                    )
                 else:
-                    # Finalize order - ``order.complete()`` performs
-                    # final cleanup of session and cart.
-                    # ``order_handler()`` can be defined by the
-                    # developer to implement custom order processing.
-                    # Then send the order email to the customer.
-                    order.transaction_id = transaction_id
-                    order.complete(request)
-                    order_handler(request, form, order)
-                    checkout.send_order_email(request, order)
-                    # Set the cookie for remembering address details
-                    # if the "remember" checkbox was checked.
-                    response = redirect("shop_complete")
-                    if form.cleaned_data.get("remember"):
-                        remembered = f"{sign(order.key)}:{order.key}"
-                        set_cookie(
-                            response, "remember", remembered, secure=request.is_secure()
-                        )
-                    else:
-                        response.delete_cookie("remember")
-                    return response
-
-            # If any checkout errors, assign them to a new form and
-            # re-run is_valid. If valid, then set form to the next step.
-            form = form_class(
-                request, step, initial=initial, data=data, errors=checkout_errors
-            )
-            if form.is_valid():
-                step += 1
-                form = form_class(request, step, initial=initial)
+                    response.delete_cookie("remember")
+                return response
+
+        # If any checkout errors, assign them to a new form and
+        # re-run is_valid. If valid, then set form to the next step.
+        form = form_class(
+            request, step, initial=initial, data=request.POST, errors=checkout_errors
+        )
+        if form.is_valid():
+            step += 1
+            form = form_class(request, step, initial=initial)
 
     # Update the step so that we don't rely on POST data to take us back to
     # the same point in the checkout process.
@@ -428,12 +483,17 @@ def order_history(request, template="shop/order_history.html", extra_context=Non
     all_orders = Order.objects.filter(user_id=request.user.id).annotate(
         quantity_total=Sum("items__quantity")
     )
-    orders = paginate(
-        all_orders.order_by("-time"),
-        request.GET.get("page", 1),
-        settings.SHOP_PER_PAGE_CATEGORY,
-        settings.MAX_PAGING_LINKS,
-    )
+    if settings.SHOP_KEYSET_PAGINATION:
+        orders = keyset_paginate(
+            request, all_orders, "-time", settings.SHOP_PER_PAGE_CATEGORY
+        )
+    else:
+        orders = paginate(
+            all_orders.order_by("-time"),
+            request.GET.get("page", 1),
+            settings.SHOP_PER_PAGE_CATEGORY,
+            settings.MAX_PAGING_LINKS,
+        )
     context = {"orders": orders, "has_pdf": HAS_PDF}
     context.update(extra_context or {})
     return TemplateResponse(request, template, context)
@@ -451,8 +511,11 @@ def invoice_resend_email(request, order_id):
         raise Http404
     if request.method == "POST":
         checkout.send_order_email(request, order)
-        msg = _("The order email for order ID %s has been re-sent") % order_id
-        info(request, msg)
+        if settings.SHOP_ORDER_EMAIL_QUEUE:
+            msg = _("The order email for order ID %s has been queued for sending")
+        else:
+            msg = _("The order email for order ID %s has been re-sent")
+        info(request, msg % order_id)
     # Determine the URL to return the user to.
     redirect_to = next_url(request)
     if redirect_to is None:
@@ -1,11 +1,21 @@
+import asyncio
 from datetime import timedelta
 from decimal import Decimal
 from functools import reduce
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
 from operator import mul
-from unittest import skipUnless
+from threading import Barrier, Thread
+from unittest import mock, skipUnless
 
 import django
-from django.test import TestCase
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages import get_messages
+from django.core import mail
+from django.core.management import call_command
+from django.db.models import F
+from django.test import TestCase, override_settings
 from django.test.client import RequestFactory
 from django.urls import reverse
 from django.utils.timezone import now
@@ -14,20 +24,36 @@ from mezzanine.conf import settings
 from mezzanine.core.models import CONTENT_STATUS_PUBLISHED
 from mezzanine.utils.importing import import_dotted_path
 
-from cartridge.shop.checkout import CHECKOUT_STEPS
-from cartridge.shop.forms import OrderForm
+from cartridge.shop.checkout import (
+    CHECKOUT_STEPS,
+    CheckoutError,
+    abillship_and_tax,
+    billship_and_tax,
+    send_order_email,
+)
+from cartridge.shop.forms import DiscountForm, OrderForm
 from cartridge.shop.models import (
     Cart,
+    CartItem,
     Category,
     DiscountCode,
     Order,
+    OrderEmail,
     Product,
     ProductImage,
     ProductOption,
     ProductVariation,
     Sale,
+    SaleProduct,
+)
+from cartridge.shop.payment import transport
+from cartridge.shop.utils import (
+    catalogue_version,
+    keyset_paginate,
+    set_shipping,
+    set_tax,
 )
-from cartridge.shop.utils import set_tax
+from cartridge.shop.views import async_checkout_steps
 
 TEST_STOCK = 5
 TEST_PRICE = Decimal("20")
@@ -106,6 +132,24 @@ class ShopTests(TestCase):
         variation = self._product.variations.all()[0]
         variation.num_in_stock = 0
         self.assertFalse(variation.has_stock())
+        # Check stock annotated for listings.
+        variation.save()
+        products = Product.objects.with_stock()
+        self.assertFalse(products.get(id=self._product.id).in_stock)
+        variation.num_in_stock = TEST_STOCK
+        variation.save()
+        self.assertTrue(products.get(id=self._product.id).in_stock)
+        variations = ProductVariation.objects.with_live_stock()
+        self.assertEqual(variations.get(id=variation.id).live_stock, TEST_STOCK)
+        # Check stock updates, preventing negative stock.
+        quantities = {variation.sku: -TEST_STOCK - 1}
+        updated = ProductVariation.objects.update_stock(quantities, False)
+        self.assertFalse(updated)
+        variation.refresh_from_db()
+        self.assertEqual(variation.num_in_stock, TEST_STOCK)
+        self.assertTrue(ProductVariation.objects.update_stock(quantities))
+        variation.refresh_from_db()
+        self.assertEqual(variation.num_in_stock, -1)
 
     def assertCategoryFilteredProducts(self, num_products):
         """
@@ -187,6 +231,177 @@ class ShopTests(TestCase):
         self._category.combined = False
         self.assertCategoryFilteredProducts(1)
 
+    @override_settings(SHOP_CATEGORY_PRODUCT_INDEX=True)
+    def test_category_product_index(self):
+        """
+        Test the stored products for a category are updated as products
+        are assigned, and as the category's filters change.
+        """
+
+        def products():
+            category_products = self._category.category_products
+            return list(category_products.values_list("product", flat=True))
+
+        self._category.products.add(self._product)
+        self.assertEqual(products(), [self._product.id])
+        self._category.products.remove(self._product)
+        self.assertEqual(products(), [])
+        self._reset_variations()
+        self._category.price_min = TEST_PRICE
+        self._category.save()
+        self.assertEqual(products(), [self._product.id])
+        response = self.client.get(self._category.get_absolute_url())
+        self.assertEqual(list(response.context["products"]), [self._product])
+
+    @override_settings(SHOP_CATEGORY_PRODUCT_INDEX=True)
+    def test_category_product_index_variations(self):
+        """
+        Test the stored products for a category are updated as the
+        product's variations are saved and deleted.
+        """
+        self._category.price_min = TEST_PRICE
+        self._category.save()
+        products = self._category.category_products
+        with self.captureOnCommitCallbacks(execute=True):
+            variation = self._product.variations.create(unit_price=TEST_PRICE)
+        self.assertEqual(products.get().product, self._product)
+        with self.captureOnCommitCallbacks(execute=True):
+            variation.delete()
+        self.assertFalse(products.exists())
+
+    @override_settings(SHOP_CATEGORY_CACHE_SECONDS=60)
+    def test_category_cache(self):
+        """
+        Test category pages are cached, and invalidated when the
+        category's products change.
+        """
+        self._category.products.add(self._product)
+        url = self._category.get_absolute_url()
+        response = self.client.get(url)
+        self.assertEqual(list(response.context["products"]), [self._product])
+        # Removing the product without signals leaves the cached page.
+        Product.categories.through.objects.all().delete()
+        response = self.client.get(url)
+        self.assertEqual(list(response.context["products"]), [self._product])
+        self.assertEqual(response.context["products"].paginator.count, 1)
+        self._category.save()
+        response = self.client.get(url)
+        self.assertEqual(list(response.context["products"]), [])
+
+    @override_settings(SHOP_CATEGORY_CACHE_SECONDS=60)
+    def test_category_cache_unpublished(self):
+        """
+        Test products that are no longer published aren't listed from
+        cached category pages.
+        """
+        self._category.products.add(self._product)
+        url = self._category.get_absolute_url()
+        response = self.client.get(url)
+        self.assertEqual(list(response.context["products"]), [self._product])
+        yesterday = now() - timedelta(days=1)
+        Product.objects.filter(id=self._product.id).update(expiry_date=yesterday)
+        response = self.client.get(url)
+        self.assertEqual(list(response.context["products"]), [])
+
+    @override_settings(SHOP_CATEGORY_CACHE_SECONDS=60)
+    def test_category_cache_sort(self):
+        """
+        Test ascending and descending sorts of a category are cached
+        separately.
+        """
+        other = Product.objects.create(**self._published)
+        self._category.products.add(self._product, other)
+        url = self._category.get_absolute_url()
+        for sort_by, expected in (
+            ("date_added", [self._product, other]),
+            ("-date_added", [other, self._product]),
+            ("date_added", [self._product, other]),
+        ):
+            response = self.client.get(url, {"sort": sort_by})
+            self.assertEqual(list(response.context["products"]), expected)
+
+    @override_settings(SHOP_PRODUCT_CACHE_SECONDS=60)
+    def test_product_cache(self):
+        """
+        Test the data for product pages is cached, and invalidated when
+        the product's variations change.
+        """
+        self._reset_variations()
+        url = self._product.get_absolute_url()
+        option_fields = {f.name for f in ProductVariation.option_fields()}
+
+        def form_fields():
+            response = self.client.get(url)
+            return set(response.context["add_product_form"].fields)
+
+        self.assertEqual(form_fields(), {"quantity"} | option_fields)
+        # Updating variations without signals leaves the cached data.
+        self._product.variations.update(unit_price=None)
+        self.assertEqual(form_fields(), {"quantity"} | option_fields)
+        self._product.save()
+        self.assertEqual(form_fields(), {"quantity"})
+
+    def test_price_sorting(self):
+        """
+        Test sorting products by price uses the same price shown for
+        each product, for products with their own sale price or on
+        sale via a current sale.
+        """
+        on_sale = Product.objects.create(unit_price="20", sale_price="5")
+        expired = Product.objects.create(
+            unit_price="15", sale_price="1", sale_to=now() - timedelta(days=1)
+        )
+        full_price = Product.objects.create(unit_price="10")
+        in_sale = Product.objects.create(unit_price="30")
+        with self.captureOnCommitCallbacks(execute=True):
+            sale = Sale.objects.create(active=True, discount_percent="90")
+            sale.products.add(in_sale)
+        products = Product.objects.filter(unit_price__isnull=False)
+        products = products.with_effective_price().order_by("effective_price")
+        self.assertEqual(list(products), [in_sale, on_sale, full_price, expired])
+        self.assertEqual([p.price() for p in products], [3, 5, 10, 15])
+        self._category.products.add(on_sale, expired, full_price, in_sale)
+        url = self._category.get_absolute_url() + "?sort=-effective_price"
+        response = self.client.get(url)
+        products = list(response.context["products"])
+        self.assertEqual(products, [expired, full_price, on_sale, in_sale])
+        self.assertEqual([p.price() for p in products], [15, 10, 5, 3])
+
+    def test_keyset_pagination(self):
+        """
+        Test walking forwards and backwards through pages of products
+        using keyset pagination, including products with a null value
+        for the sort field, matches ordering by offset.
+        """
+        for price in (None, "1", "2", "2", None, "3", "4"):
+            Product.objects.create(unit_price=price)
+        products = Product.objects.all()
+        orderings = (
+            ("unit_price", F("unit_price").asc(nulls_last=True), "pk"),
+            ("-unit_price", F("unit_price").desc(nulls_last=True), "-pk"),
+        )
+        for order_by, *ordering in orderings:
+            expected = list(products.order_by(*ordering))
+            pages = []
+            querystring = ""
+            while True:
+                request = RequestFactory().get("/?" + querystring)
+                page = keyset_paginate(request, products, order_by, 3)
+                pages.append(list(page))
+                if not page.has_next:
+                    break
+                querystring = page.next_querystring
+            self.assertEqual(sum(pages, []), expected)
+            while page.has_previous:
+                request = RequestFactory().get("/?" + page.previous_querystring)
+                page = keyset_paginate(request, products, order_by, 3)
+                self.assertEqual(list(page), pages.pop(-2))
+        self._category.products.add(*products)
+        with self.settings(SHOP_KEYSET_PAGINATION=True, SHOP_PER_PAGE_CATEGORY=3):
+            response = self.client.get(self._category.get_absolute_url())
+            self.assertEqual(len(response.context["products"]), 3)
+            self.assertContains(response, response.context["products"].next_querystring)
+
     def _add_to_cart(self, variation, quantity):
         """
         Given a variation, creates the dict for posting to the cart
@@ -197,6 +412,22 @@ class ShopTests(TestCase):
         data["quantity"] = quantity
         self.client.post(variation.product.get_absolute_url(), data)
 
+    def _checkout_data(self, **overrides):
+        """
+        Creates the dict for posting the final checkout step, with a
+        value for each of the order form's fields.
+        """
+        data = {
+            "step": len(CHECKOUT_STEPS),
+            "billing_detail_email": "example@example.com",
+            "discount_code": "",
+        }
+        data.update(overrides)
+        for field_name, field in list(OrderForm(None, None).fields.items()):
+            value = field.choices[-1][1] if hasattr(field, "choices") else "1"
+            data.setdefault(field_name, value)
+        return data
+
     def _empty_cart(self, cart):
         """
         Given a cart, creates the dict for posting to the cart form
@@ -262,6 +493,81 @@ class ShopTests(TestCase):
         self.assertEqual(cart.total_quantity(), 0)
         self.assertEqual(cart.total_price(), Decimal("0"))
 
+    @override_settings(SHOP_CART_SNAPSHOT=True)
+    def test_cart_snapshot(self):
+        """
+        Test the cart and its items are loaded with a single query when
+        ``SHOP_CART_SNAPSHOT`` is True, and that the cart's last updated
+        time is only written once it's older than
+        ``SHOP_CART_TOUCH_MINUTES``.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        self._add_to_cart(variation, TEST_STOCK)
+
+        class request:
+            session = self.client.session
+
+        # Load the session before counting queries.
+        cart_id = request.session["cart"]
+        with self.assertNumQueries(1):
+            cart = Cart.objects.from_request(request)
+            self.assertTrue(cart.has_items())
+            self.assertEqual(cart.total_quantity(), TEST_STOCK)
+            self.assertEqual(cart.total_price(), TEST_PRICE * TEST_STOCK)
+            self.assertEqual(cart.skus(), [variation.sku])
+
+        minutes = settings.SHOP_CART_TOUCH_MINUTES + 1
+        last_updated = now() - timedelta(minutes=minutes)
+        Cart.objects.filter(id=cart_id).update(last_updated=last_updated)
+        cart = Cart.objects.from_request(request)
+        self.assertGreater(cart.last_updated, last_updated)
+        self.assertEqual(Cart.objects.get(id=cart_id).last_updated, cart.last_updated)
+
+    def test_purge_expired_carts(self):
+        """
+        Test expired carts and their items are purged in batches,
+        releasing their stock, and current carts are left alone.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        minutes = settings.SHOP_CART_EXPIRY_MINUTES + 1
+        expired = now() - timedelta(minutes=minutes)
+        for i in range(3):
+            cart = Cart.objects.create(last_updated=expired)
+            cart.items.create(sku=variation.sku, quantity=1)
+        current = Cart.objects.create(last_updated=now())
+        current.items.create(sku=variation.sku, quantity=1)
+        variation.refresh_from_db()
+        self.assertEqual(variation.num_in_carts, 4)
+        call_command("purge_carts", batch_size=2, sleep=0, stdout=StringIO())
+        self.assertEqual(list(Cart.objects.all()), [current])
+        self.assertEqual(CartItem.objects.count(), 1)
+        variation.refresh_from_db()
+        self.assertEqual(variation.num_in_carts, 1)
+
+    def test_cart_item_reserve_stale(self):
+        """
+        Test saving the same cart item from separately loaded copies
+        reserves stock against the quantity stored by the other.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        cart = Cart.objects.create()
+        item = cart.items.create(sku=variation.sku, quantity=1)
+        first, second = CartItem.objects.get(id=item.id), CartItem.objects.get(
+            id=item.id
+        )
+        first.quantity = 3
+        first.save()
+        second.quantity = 2
+        second.save()
+        variation.refresh_from_db()
+        self.assertEqual(variation.num_in_carts, 2)
+        second.delete()
+        variation.refresh_from_db()
+        self.assertEqual(variation.num_in_carts, 0)
+
     def test_discount_codes(self):
         """
         Test that all types of discount codes are applied.
@@ -307,6 +613,15 @@ class ShopTests(TestCase):
                     expected = discount_value
                 self.assertEqual(discount_total, expected)
                 if discount_target == "item":
+                    # Eligible SKUs are cached once the code is applied.
+                    skus = self._product.variations.values_list("sku", flat=True)
+                    skus = set(skus)
+                    with self.assertNumQueries(0):
+                        self.assertEqual(discount.eligible_skus(), skus)
+                    cart = Cart.objects.from_request(self.client)
+                    breakdown = cart.discount_breakdown(discount)
+                    self.assertEqual(list(breakdown["items"]), [variation.sku])
+                    self.assertEqual(breakdown["total"], expected)
                     # Test discount isn't applied for an invalid product.
                     cart = Cart.objects.from_request(self.client)
                     self._empty_cart(cart)
@@ -326,6 +641,46 @@ class ShopTests(TestCase):
                             _("The discount code entered is invalid."),
                         )
 
+    @override_settings(SHOP_DISCOUNT_CODE_CACHE_SECONDS=60)
+    def test_discount_code_cache(self):
+        """
+        Test discount codes and unknown codes are cached once looked
+        up, and invalidated when discount codes change, without
+        invalidating cached catalogue data.
+        """
+        version = catalogue_version()
+        DiscountCode.objects.create(code="cached", active=True)
+        for code in ("cached", "unknown"):
+            try:
+                DiscountCode.objects.get_active(code)
+            except DiscountCode.DoesNotExist:
+                pass
+        self.assertTrue(DiscountCode.objects.any_active())
+        with self.assertNumQueries(0):
+            self.assertEqual(DiscountCode.objects.get_active("cached").code, "cached")
+            with self.assertRaises(DiscountCode.DoesNotExist):
+                DiscountCode.objects.get_active("unknown")
+            self.assertTrue(DiscountCode.objects.any_active())
+        DiscountCode.objects.create(code="unknown", active=True)
+        self.assertEqual(DiscountCode.objects.get_active("unknown").code, "unknown")
+        self.assertEqual(catalogue_version(), version)
+
+    def test_discount_code_reserve(self):
+        """
+        Test a discount code can't be reserved more times than it has
+        uses remaining, and that releasing it returns the use.
+        """
+        discount = DiscountCode.objects.create(
+            code="limited", active=True, uses_remaining=1
+        )
+        order = Order(discount_code="limited")
+        self.assertTrue(order.reserve_discount())
+        self.assertFalse(Order(discount_code="limited").reserve_discount())
+        order.release_discount()
+        discount.refresh_from_db()
+        self.assertEqual(discount.uses_remaining, 1)
+        self.assertTrue(Order(discount_code="").reserve_discount())
+
     def test_order(self):
         """
         Test that a completed order contains cart items and that
@@ -339,14 +694,7 @@ class ShopTests(TestCase):
         cart = Cart.objects.from_request(self.client)
 
         # Post order.
-        data = {
-            "step": len(CHECKOUT_STEPS),
-            "billing_detail_email": "example@example.com",
-            "discount_code": "",
-        }
-        for field_name, field in list(OrderForm(None, None).fields.items()):
-            value = field.choices[-1][1] if hasattr(field, "choices") else "1"
-            data.setdefault(field_name, value)
+        data = self._checkout_data()
         self.client.post(reverse("shop_checkout"), data)
         try:
             order = Order.objects.from_request(self.client)
@@ -359,9 +707,294 @@ class ShopTests(TestCase):
         self.assertEqual(len(items), 1)
         self.assertEqual(items[0].sku, variation.sku)
         self.assertEqual(items[0].quantity, TEST_STOCK)
+        self.assertEqual(items[0].total_price, TEST_PRICE * TEST_STOCK)
         self.assertEqual(variation.num_in_stock, TEST_STOCK)
+        self.assertEqual(variation.num_in_carts, 0)
         self.assertEqual(order.item_total, TEST_PRICE * TEST_STOCK)
 
+    @override_settings(SHOP_ORDER_ALLOW_NEGATIVE_STOCK=False)
+    def test_order_payment_error(self):
+        """
+        Test that the order is rolled back, and its stock and discount
+        code reservations returned, when payment is declined.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        self._add_to_cart(variation, TEST_STOCK)
+        DiscountCode.objects.create(code="limited", active=True, uses_remaining=1)
+        data = self._checkout_data(discount_code="limited")
+
+        def payment_handler(request, order_form, order):
+            # Stock and the discount code are reserved during payment.
+            variation.refresh_from_db()
+            self.assertEqual(variation.num_in_stock, TEST_STOCK)
+            self.assertEqual(DiscountCode.objects.get().uses_remaining, 0)
+            raise CheckoutError("Declined")
+
+        handler = "cartridge.shop.views.payment_handler"
+        with mock.patch(handler, side_effect=payment_handler) as handler:
+            self.client.post(reverse("shop_checkout"), data)
+        self.assertTrue(handler.called)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(DiscountCode.objects.get().uses_remaining, 1)
+        variation = self._product.variations.all()[0]
+        self.assertEqual(variation.num_in_stock, TEST_STOCK * 2)
+        self.assertEqual(variation.num_in_carts, TEST_STOCK)
+
+    @override_settings(SHOP_ORDER_ALLOW_NEGATIVE_STOCK=False)
+    def test_order_payment_unexpected_error(self):
+        """
+        Test that the order and its reservations are kept when payment
+        fails with an error other than ``CheckoutError``, since the
+        payment may have been taken.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        self._add_to_cart(variation, TEST_STOCK)
+        DiscountCode.objects.create(code="limited", active=True, uses_remaining=1)
+        data = self._checkout_data(discount_code="limited")
+        payment = "cartridge.shop.views.payment_handler"
+        with mock.patch(payment, side_effect=OSError("Timed out")):
+            with self.assertRaises(OSError):
+                self.client.post(reverse("shop_checkout"), data)
+        order = Order.objects.get()
+        self.assertEqual(order.items.get().quantity, TEST_STOCK)
+        self.assertEqual(order.discount_code, "limited")
+        self.assertEqual(DiscountCode.objects.get().uses_remaining, 0)
+        variation.refresh_from_db()
+        self.assertEqual(variation.num_in_stock, TEST_STOCK)
+
+    @override_settings(SHOP_ORDER_ALLOW_NEGATIVE_STOCK=False)
+    def test_order_complete_error(self):
+        """
+        Test that a paid order remains on record with its stock and
+        discount code reserved when completing it fails.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        self._add_to_cart(variation, TEST_STOCK)
+        DiscountCode.objects.create(code="limited", active=True, uses_remaining=1)
+        data = self._checkout_data(discount_code="limited")
+
+        payment = "cartridge.shop.views.payment_handler"
+        complete = "cartridge.shop.models.Order.complete"
+        with mock.patch(payment, return_value="paid"):
+            with mock.patch(complete, side_effect=ValueError("Complete failed")):
+                with self.assertRaises(ValueError):
+                    self.client.post(reverse("shop_checkout"), data)
+        order = Order.objects.get()
+        self.assertEqual(order.transaction_id, "paid")
+        self.assertEqual(order.items.get().quantity, TEST_STOCK)
+        self.assertEqual(DiscountCode.objects.get().uses_remaining, 0)
+        variation.refresh_from_db()
+        self.assertEqual(variation.num_in_stock, TEST_STOCK)
+
+    def test_sale_price_in_cart(self):
+        """
+        Test the price added to the cart for overlapping sales is the
+        lowest price, as shown when listing products, rather than the
+        price of the most recently saved sale.
+        """
+        self._reset_variations()
+        with self.captureOnCommitCallbacks(execute=True):
+            for percent in ("50", "10"):
+                sale = Sale.objects.create(active=True, discount_percent=percent)
+                sale.products.add(self._product)
+        variation = self._product.variations.all()[0]
+        self.assertEqual(variation.price(), TEST_PRICE * Decimal("0.9"))
+        listed = ProductVariation.objects.with_effective_price().get(id=variation.id)
+        self.assertEqual(listed.price(), TEST_PRICE / 2)
+        self._add_to_cart(variation, 1)
+        cart = Cart.objects.from_request(self.client)
+        self.assertEqual(cart.items.get().unit_price, TEST_PRICE / 2)
+
+    def test_sale_price_rounded(self):
+        """
+        Test a percentage sale price is rounded to the stored precision,
+        so that adding the same variation again updates its cart item.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        variation.unit_price = Decimal("19.99")
+        variation.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            sale = Sale.objects.create(active=True, discount_percent="15")
+            sale.products.add(self._product)
+        listed = ProductVariation.objects.with_effective_price().get(id=variation.id)
+        self.assertEqual(listed.price(), Decimal("16.99"))
+        self._add_to_cart(variation, 1)
+        self._add_to_cart(variation, 1)
+        item = Cart.objects.from_request(self.client).items.get()
+        self.assertEqual((item.unit_price, item.quantity), (Decimal("16.99"), 2))
+
+    def test_recalculate_cart(self):
+        """
+        Test the discount is only validated again when the cart is
+        recalculated if the cart or discount code has changed.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        DiscountCode.objects.create(code="ten", discount_deduct=10, active=True)
+        self._add_to_cart(variation, 1)
+        set_discount = DiscountForm.set_discount
+        with mock.patch.object(
+            DiscountForm, "set_discount", autospec=True, side_effect=set_discount
+        ) as set_discount:
+            self.client.post(reverse("shop_cart"), {"discount_code": "ten"})
+            self.assertEqual(set_discount.call_count, 2)
+            # Set by the cart view, but not again when recalculating.
+            self.client.post(reverse("shop_cart"), {"discount_code": "ten"})
+            self.assertEqual(set_discount.call_count, 3)
+            self._add_to_cart(variation, 1)
+            self.assertEqual(set_discount.call_count, 4)
+        self.assertEqual(self.client.session["discount_total"], "10.00")
+
+    @override_settings(SHOP_CHECKOUT_HANDLER_MEMO=False)
+    def test_async_handlers(self):
+        """
+        Test that coroutine billing/shipping and tax handlers are
+        awaited concurrently, for both the sync and async views.
+        """
+        started = []
+        seen = []
+
+        async def handler(request, order_form):
+            # Wait for the other handler to start, which only happens
+            # if they're run concurrently.
+            started.append(handler)
+            for i in range(100):
+                if not len(started) % 2:
+                    break
+                await asyncio.sleep(0.01)
+            seen.append(len(started))
+
+        request = mock.Mock(session={})
+        billship_and_tax(request, None, handler, handler)
+        self.assertEqual(seen, [2, 2])
+        async_to_sync(abillship_and_tax)(request, None, handler, handler)
+        self.assertEqual(seen, [2, 2, 4, 4])
+
+    def test_async_checkout_steps(self):
+        """
+        Test an order is placed via ``async_checkout_steps`` with a
+        coroutine billing/shipping handler.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        self._add_to_cart(variation, TEST_STOCK)
+        data = self._checkout_data()
+
+        async def billship_handler(request, order_form):
+            set_shipping(request, "Async shipping", 10)
+
+        request = RequestFactory().post(reverse("shop_checkout"), data)
+        # Build the request as the middleware would, since the URL for
+        # the checkout uses the sync view.
+        request.session = self.client.session
+        request.user = AnonymousUser()
+        request.cart = Cart.objects.from_request(request)
+        handler = "cartridge.shop.views.billship_handler"
+        with mock.patch(handler, billship_handler):
+            response = async_to_sync(async_checkout_steps)(request)
+        self.assertRedirects(
+            response, reverse("shop_complete"), fetch_redirect_response=False
+        )
+        order = Order.objects.get()
+        self.assertEqual(order.shipping_type, "Async shipping")
+        self.assertEqual(order.shipping_total, 10)
+        self.assertEqual(order.items.get().quantity, TEST_STOCK)
+        self.assertIn("no-cache", response["Cache-Control"])
+
+    @override_settings(SHOP_CHECKOUT_HANDLER_THREADS=2, SHOP_CHECKOUT_HANDLER_MEMO=True)
+    def test_handler_threads_and_memo(self):
+        """
+        Test that sync billing/shipping and tax handlers are called
+        concurrently in threads, and aren't called again while the cart
+        and address are unchanged.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        cart = Cart.objects.create()
+        cart.add_item(variation, 1)
+        # Each handler waits for the other to start.
+        barrier = Barrier(2, timeout=5)
+        calls = []
+
+        def billship(request, order_form):
+            barrier.wait()
+            calls.append(billship)
+            set_shipping(request, "Shipping", 10)
+
+        def tax(request, order_form):
+            barrier.wait()
+            calls.append(tax)
+            set_tax(request, "Tax", 1)
+
+        def run():
+            request.cart = Cart.objects.get(id=cart.id)
+            billship_and_tax(request, None, billship, tax)
+            return len(calls)
+
+        order = {"billing_detail_city": "Sydney", "step": 1}
+        request = mock.Mock(session={"order": order})
+        # Tests run in a transaction, where threads aren't used.
+        connection = mock.patch("cartridge.shop.checkout.connection")
+        connection.start().in_atomic_block = False
+        self.addCleanup(connection.stop)
+        self.assertEqual(run(), 2)
+        self.assertEqual(request.session["shipping_total"], "10")
+        # Unchanged inputs restore the results without calling handlers.
+        del request.session["shipping_total"]
+        order["step"] = 2
+        self.assertEqual(run(), 2)
+        self.assertEqual(request.session["shipping_total"], "10")
+        order["billing_detail_city"] = "Melbourne"
+        self.assertEqual(run(), 4)
+        cart.add_item(variation, 1)
+        self.assertEqual(run(), 6)
+
+    @override_settings(SHOP_ORDER_EMAIL_QUEUE=True)
+    def test_order_email_queue(self):
+        """
+        Test order emails are queued and sent by the management
+        command, and that failed attempts are retried.
+        """
+        order = Order.objects.create(billing_detail_email="example@example.com")
+        send_order_email(None, order)
+        self.assertEqual(len(mail.outbox), 0)
+        with mock.patch("cartridge.shop.checkout.send_mail_template") as send:
+            send.side_effect = OSError("Connection refused")
+            call_command("send_order_emails", stdout=StringIO())
+        email = order.emails.get()
+        self.assertEqual((email.sent, email.attempts), (None, 1))
+        self.assertEqual(email.error, "Connection refused")
+        OrderEmail.objects.update(next_attempt=now())
+        call_command("send_order_emails", stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIsNotNone(order.emails.get().sent)
+        # Resending the email reports that it's been queued.
+        Order.objects.filter(id=order.id).update(key=self.client.session.session_key)
+        url = reverse("shop_invoice_resend", args=[order.id])
+        response = self.client.post(url)
+        message = str(list(get_messages(response.wsgi_request))[0])
+        self.assertIn("queued for sending", message)
+        self.assertEqual(order.emails.count(), 2)
+
+    @override_settings(
+        SHOP_PRODUCT_ACTION_BUFFER_SIZE=3, SHOP_PRODUCT_ACTION_BUFFER_SECONDS=60
+    )
+    def test_product_actions_buffered(self):
+        """
+        Test product actions are buffered until the buffer is full.
+        """
+        self._product.actions.added_to_cart()
+        self._product.actions.purchased()
+        self.assertFalse(self._product.actions.exists())
+        self._product.actions.added_to_cart()
+        action = self._product.actions.get()
+        self.assertEqual(action.total_cart, 2)
+        self.assertEqual(action.total_purchase, 1)
+
     def test_product_image_deletion_does_not_delete_referenced_variation(self):
         from io import BytesIO
 
@@ -430,18 +1063,176 @@ class SaleTests(TestCase):
         # Activate the sale and verify the prices.
         sale = Sale.objects.all()[0]
         sale.active = True
-        sale.save()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            sale.save()
+            sale.products.add(*Product.objects.all())
+        self.assertEqual(len(callbacks), 2)
 
-        # Afterward ensure that all the sale prices have been updated.
+        # Afterward ensure that all the sale prices have been updated,
+        # and that the sale was only applied once.
         for product in Product.objects.all():
             self.assertTrue(product.sale_price)
         for variation in ProductVariation.objects.all():
             self.assertTrue(variation.sale_price)
+        sale.refresh_from_db()
+        self.assertEqual(sale.update_status, Sale.UPDATE_COMPLETE)
+        self.assertEqual(sale.update_progress, 6)
+
+    @override_settings(SHOP_SALE_UPDATE_QUEUE=True)
+    def test_apply_sales_command(self):
+        """
+        Test queued sales are left for the ``apply_sales`` command to
+        apply.
+        """
+        sale = Sale.objects.get()
+        sale.active = True
+        with self.captureOnCommitCallbacks(execute=True):
+            sale.save()
+        sale.refresh_from_db()
+        self.assertEqual(sale.update_status, Sale.UPDATE_QUEUED)
+        self.assertFalse(Product.objects.filter(sale_id=sale.id).exists())
+        call_command("apply_sales", stdout=StringIO())
+        sale.refresh_from_db()
+        self.assertEqual(sale.update_status, Sale.UPDATE_COMPLETE)
+        self.assertEqual(Product.objects.filter(sale_id=sale.id).count(), 2)
+
+    def test_sale_changed_while_running(self):
+        """
+        Test a sale changed while it's being applied isn't applied again
+        concurrently, but once the current run finishes.
+        """
+        sale = Sale.objects.get()
+        sale.active = True
+        runs = []
+
+        def apply(sale):
+            runs.append(sale.id)
+            if len(runs) == 1:
+                Sale.objects.schedule_update(sale.id)
+                self.assertFalse(Sale.objects.run_update(sale.id))
+                status = Sale.objects.get().update_status
+                self.assertEqual(status, Sale.UPDATE_CHANGED)
+
+        with mock.patch.object(Sale, "apply", autospec=True, side_effect=apply):
+            with self.captureOnCommitCallbacks(execute=True):
+                sale.save()
+        self.assertEqual(runs, [sale.id, sale.id])
+        sale.refresh_from_db()
+        self.assertEqual(sale.update_status, Sale.UPDATE_COMPLETE)
+
+    @override_settings(SHOP_SALE_UPDATE_BATCH_SIZE=3)
+    def test_sale_save_batched(self):
+        """
+        Test the sale is applied in batches of IDs as it is on MySQL.
+        """
+        sale = Sale.objects.get()
+        sale.active = True
+        mysql = {"ENGINE": "django.db.backends.mysql"}
+        with mock.patch.dict(settings.DATABASES["default"], mysql):
+            with self.captureOnCommitCallbacks(execute=True):
+                sale.save()
+        for priced in list(Product.objects.all()) + list(
+            ProductVariation.objects.all()
+        ):
+            self.assertEqual(priced.sale_id, sale.id)
+            self.assertEqual(priced.sale_price, Decimal("0.89"))
+        sale.refresh_from_db()
+        self.assertEqual(sale.update_status, Sale.UPDATE_COMPLETE)
+        self.assertEqual(sale.update_progress, 6)
+
+    def test_effective_price(self):
+        """
+        Test sale prices resolved when querying use the lowest price
+        of overlapping sales, and respect each sale's active flag, and
+        date range without updating products.
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            for percent in ("10", "50"):
+                sale = Sale.objects.create(
+                    title=percent, active=True, discount_percent=percent
+                )
+                sale.products.add(*Product.objects.all())
+        products = Product.objects.with_effective_price()
+        variations = ProductVariation.objects.with_effective_price()
+        for priced in list(products) + list(variations):
+            self.assertTrue(priced.on_sale())
+            self.assertEqual(priced.price(), Decimal("0.64"))
+        # Deactivating the sale clears the sale price stored for it.
+        with self.captureOnCommitCallbacks(execute=True):
+            sale.active = False
+            sale.save()
+        for priced in Product.objects.with_effective_price():
+            self.assertEqual(priced.price(), Decimal("1.14"))
+        Sale.objects.update(valid_to=now() - timedelta(days=1))
+        for priced in Product.objects.with_effective_price():
+            self.assertFalse(priced.on_sale())
+            self.assertEqual(priced.price(), Decimal("1.27"))
+
+    def test_effective_price_percent(self):
+        """
+        Test a percentage sale on a whole price gives the exact price.
+        """
+        product = Product.objects.create(unit_price="20")
+        with self.captureOnCommitCallbacks(execute=True):
+            sale = Sale.objects.create(active=True, discount_percent="50")
+            sale.products.add(product)
+        product = Product.objects.with_effective_price().get(id=product.id)
+        self.assertTrue(product.on_sale())
+        self.assertEqual(product.price(), Decimal("10"))
+
+    def test_effective_price_stored(self):
+        """
+        Test a product's own sale price is used when it's lower than
+        the current sales, and only within its date range.
+        """
+        product = Product.objects.create(unit_price="20", sale_price="5")
+        with self.captureOnCommitCallbacks(execute=True):
+            sale = Sale.objects.create(active=True, discount_percent="50")
+        SaleProduct.objects.create(sale=sale, product=product)
+        product = Product.objects.with_effective_price().get(id=product.id)
+        self.assertEqual(product.price(), Decimal("5"))
+        product.sale_to = now() - timedelta(days=1)
+        product.save()
+        product = Product.objects.with_effective_price().get(id=product.id)
+        self.assertEqual(product.price(), Decimal("10"))
+
+    @override_settings(SHOP_CATEGORY_PRODUCT_INDEX=True)
+    def test_sale_delete_categories(self):
+        """
+        Test deleting a sale updates the stored products for categories
+        filtered by price.
+        """
+        category = Category.objects.create(title="test", price_max="1")
+        sale = Sale.objects.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            sale.active = True
+            sale.save()
+        products = category.category_products.values_list("product", flat=True)
+        product_ids = Product.objects.values_list("id", flat=True)
+        self.assertEqual(set(products), set(product_ids))
+        with self.captureOnCommitCallbacks(execute=True):
+            sale.delete()
+        self.assertFalse(category.category_products.exists())
+
+    def test_sale_reverse_clear(self):
+        """
+        Test clearing sales from a product updates the sale prices.
+        """
+        sale = Sale.objects.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            sale.active = True
+            sale.save()
+        product = Product.objects.first()
+        with self.captureOnCommitCallbacks(execute=True):
+            product.sale_set.clear()
+        product.refresh_from_db()
+        self.assertIsNone(product.sale_price)
+        other = Product.objects.exclude(id=product.id).get()
+        self.assertIsNotNone(other.sale_price)
 
 
 try:
     __import__("stripe")
-    from unittest import mock
 except ImportError:
     stripe_used = False
 else:
@@ -506,6 +1297,50 @@ if stripe_used:
     StripeTests.test_charge = mock.patch(charge)(StripeTests.test_charge)
 
 
+class PaymentTransportTests(TestCase):
+    def test_connection_reused(self):
+        """
+        Test connections to a gateway are reused across requests, and
+        each request is reported via the ``gateway_request`` signal.
+        """
+        connections = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                connections.append(self.client_address)
+                super().setup()
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = "http://127.0.0.1:%s/pay" % server.server_port
+        requests = []
+
+        def receiver(**kwargs):
+            requests.append(kwargs)
+
+        transport.gateway_request.connect(receiver)
+        self.addCleanup(transport.gateway_request.disconnect, receiver)
+        for amount in ("1", "2"):
+            response = transport.post(url, {"amount": amount})
+            self.assertEqual(response, b"amount=" + amount.encode())
+        self.assertEqual(len(connections), 1)
+        self.assertEqual([r["status"] for r in requests], [200, 200])
+
+
 class TaxationTests(TestCase):
     def test_default_handler_exists(self):
         """